@@ -0,0 +1,149 @@
+import sys, threading, collections
+from multiprocessing.pool import ThreadPool
+import tagger as tagger_module
+
+'''
+Non-blocking tagging API for embedding the tagger in an event-driven or
+threaded ingestion service. Decoding runs off the calling thread, on a
+background thread or on a pool of worker processes:
+
+    async_tagger = AsyncTagger(tagger, workers=4)
+    future = async_tagger.tag(sentence)             # returns at once
+    tags, log_prob = future.get()
+    for tags, log_prob in async_tagger.tag_stream(sentences):
+        ...
+    async_tagger.close()
+
+At most max_pending sentences are in flight at once: tag() blocks the
+caller when that many are waiting to be decoded (backpressure), and
+tag_stream() reads ahead at most that many sentences of its input while
+yielding results in input order.
+'''
+
+
+def decode_sentence(tagger, sentence, engine, beam):
+    ''' Decode one sentence and return (True, (tags, log_prob)), or
+        (False, message) if decoding raised
+    '''
+    try:
+        return (True, tagger.get_sentence_tags(sentence, engine, beam))
+    except Exception, e:
+        return (False, str(e))
+
+def decode_worker(sentence):
+    ''' decode_sentence in a pool worker process (see tagger.init_worker)
+    '''
+    return decode_sentence(tagger_module.worker_tagger, sentence,
+                           tagger_module.worker_engine, tagger_module.worker_beam)
+
+
+class TagFuture(object):
+    ''' The pending result of AsyncTagger.tag
+    '''
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def ready(self):
+        return self.done.is_set()
+
+    def get(self, timeout=None):
+        ''' Wait for the sentence to be decoded and return (tags, log_prob)
+        '''
+        if not self.done.wait(timeout):
+            raise Exception('Tagging did not finish within %s seconds' % timeout)
+        if self.error is not None:
+            raise Exception(self.error)
+        return self.result
+
+
+class AsyncTagger(object):
+    ''' Tags sentences off the calling thread. With workers <= 1 sentences
+        are decoded one at a time by a background thread (decoding is CPU
+        bound, so more threads would not decode faster); with workers > 1
+        they are decoded by a pool of worker processes, each inheriting the
+        model.
+    '''
+
+    def __init__(self, tagger, engine='viterbi', beam=None, workers=1, max_pending=64):
+        if max_pending < 1:
+            raise Exception('max_pending must be at least 1')
+        self.tagger = tagger
+        self.engine = engine
+        self.beam = beam
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        if workers > 1:
+            tagger.prepare_workers(engine, beam)
+            self.pool = tagger.start_pool(workers, tagger_module.init_worker, (tagger, engine, beam))
+        else:
+            self.pool = ThreadPool(1)
+
+    def tag(self, sentence, callback=None):
+        ''' Queue a sentence for decoding and return a TagFuture for its
+            (tags, log_prob). Blocks while max_pending sentences are in
+            flight. If given, callback(future) is called (on a pool thread)
+            once the sentence is decoded; an exception it raises is written
+            to stderr, as the pool thread must survive it.
+        '''
+        self.slots.acquire()
+        future = TagFuture()
+
+        def finished(outcome):
+            ok, value = outcome
+            if ok:
+                future.result = value
+            else:
+                future.error = value
+            future.done.set()
+            self.slots.release()
+            if callback is not None:
+                try:
+                    callback(future)
+                except Exception, e:
+                    sys.stderr.write("AsyncTagger callback raised: %s\n" % e)
+
+        try:
+            if isinstance(self.pool, ThreadPool):
+                self.pool.apply_async(decode_sentence, (self.tagger, sentence, self.engine, self.beam),
+                                      callback=finished)
+            else:
+                self.pool.apply_async(decode_worker, (sentence,), callback=finished)
+        except:
+            self.slots.release()
+            raise
+        return future
+
+    def tag_stream(self, sentences):
+        ''' Generate (tags, log_prob) for each sentence of an iterable, in
+            input order. Up to max_pending sentences are read ahead and
+            decoded while earlier results are consumed, so reading the
+            input overlaps with decoding.
+        '''
+        pending = collections.deque()
+        for sentence in sentences:
+            pending.append(self.tag(sentence))
+            # Yield the results that are already done, and wait for the
+            # oldest one once the read-ahead limit is reached
+            while pending and (pending[0].ready() or len(pending) >= self.max_pending):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        ''' Wait for the queued sentences and stop the pool
+        '''
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
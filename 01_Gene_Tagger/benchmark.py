@@ -0,0 +1,230 @@
+import os, sys, time, json, resource, argparse, tempfile
+from tagger import Tagger, ENGINES
+from eval_gene_tagger import Evaluator, corpus_iterator
+
+'''
+Benchmark the load, decode and evaluation throughput of the gene tagger on
+the shipped data files, and compare the results against a stored baseline:
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --threshold 0.1
+
+Exits with status 1 if any aggregate metric regressed by more than the
+threshold (and, for the *_secs timings of whole phases, by more than
+--min-secs: phases of a few milliseconds vary by more than 10% between
+runs). The tokens_per_sec of tag_file and compare is reported but not
+compared, as it only restates their *_secs timing. The decode percentiles
+are pooled over the latencies of every repeated pass and
+decode.tokens_per_sec is that of the fastest pass. The
+p99 and the per-length-bucket latencies are reported but not compared:
+they hinge on a few sub-millisecond sentences and are too noisy to gate
+on, so decode speed is gated through p50 and tokens_per_sec.
+'''
+
+# Sentence length buckets (inclusive upper bounds) for the decode latencies
+LENGTH_BUCKETS = [10, 20, 40, 80]
+# Metrics reported but never counted as regressions (see find_regressions)
+UNGATED_PREFIXES = ['decode.by_length.', 'decode.p99_ms',
+                    'tag_file.tokens_per_sec', 'compare.tokens_per_sec']
+
+
+def timed(function, *args):
+    ''' Call function(*args) and return the tuple (seconds, result)
+    '''
+    start = time.time()
+    result = function(*args)
+    return (time.time() - start, result)
+
+def percentile(values, p):
+    ''' Return the p-th percentile (0-100) of the given values (nearest rank)
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def peak_rss_kb():
+    ''' Return the peak resident set size of this process in kilobytes
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is in bytes on OS X
+        rss /= 1024
+    return rss
+
+def get_bucket(length):
+    ''' Return the name of the length bucket of a sentence (ie, "11-20")
+    '''
+    low = 1
+    for high in LENGTH_BUCKETS:
+        if length <= high:
+            return '%i-%i' % (low, high)
+        low = high + 1
+    return '%i+' % low
+
+def latency_stats(latencies, tokens):
+    ''' Summarize per-sentence latencies (seconds) of sentences with `tokens` words
+    '''
+    total = sum(latencies)
+    return {
+        'sentences': len(latencies),
+        'tokens_per_sec': total and tokens / total or 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+def run_benchmarks(counts_file, dev_file, key_file, test_file, engine='viterbi', repeat=3):
+    ''' Run each benchmark and return the results as a (nested) dictionary
+    '''
+    results = {'engine': engine, 'repeat': repeat}
+
+    # Loading the model, into a new Tagger each time (the fastest load counts)
+    read_secs = []
+    flag_secs = []
+    compile_secs = []
+    for i in range(repeat):
+        tagger = Tagger()
+        read_secs.append(timed(tagger.read_tag_count_file, counts_file)[0])
+        flag_secs.append(timed(tagger.flag_rare_words)[0])
+        compile_secs.append(timed(tagger.compile_model)[0])
+    results['load'] = {
+        'read_tag_count_file_secs': min(read_secs),
+        'flag_rare_words_secs': min(flag_secs),
+        'compile_model_secs': min(compile_secs),
+    }
+
+    # Per-sentence decoding of the test file, broken down by sentence length
+    test = open(test_file, 'r')
+    sentences = list(tagger.iter_sentences(test))
+    test.close()
+    tokens = sum(len(sentence) for sentence in sentences)
+    latencies = []
+    pass_secs = []
+    bucket_latencies = {}
+    bucket_tokens = {}
+    for i in range(repeat):
+        for sentence in sentences:
+            secs, _ = timed(tagger.get_sentence_tags, sentence, engine)
+            latencies.append(secs)
+            bucket = get_bucket(len(sentence))
+            bucket_latencies.setdefault(bucket, []).append(secs)
+            bucket_tokens[bucket] = bucket_tokens.get(bucket, 0) + len(sentence)
+        pass_secs.append(sum(latencies[-len(sentences):]))
+    # Percentiles over the latencies of every pass pooled together (the
+    # sentences are sub-millisecond, so one pass's p99 is mostly timer
+    # jitter), throughput of the fastest pass
+    results['decode'] = latency_stats(latencies, tokens * repeat)
+    results['decode']['tokens_per_sec'] = tokens / max(min(pass_secs), 1e-9)
+    results['decode']['by_length'] = dict((bucket, latency_stats(bucket_latencies[bucket], bucket_tokens[bucket]))
+                                          for bucket in bucket_latencies)
+
+    # End-to-end tag_file of the dev file, then scoring it against the key
+    handle, output_file = tempfile.mkstemp(suffix='.out')
+    os.close(handle)
+    dev_tokens = sum(len(sentence) for sentence in tagger.iter_sentences(open(dev_file, 'r')))
+    stderr = sys.stderr
+    tag_secs = []
+    compare_secs = []
+    try:
+        for i in range(repeat):
+            # Keep tag_file progress output out of the timings
+            sys.stderr = open(os.devnull, 'w')
+            try:
+                secs, _ = timed(tagger.tag_file, dev_file, output_file, engine)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            tag_secs.append(secs)
+            evaluator = Evaluator()
+            secs, _ = timed(evaluator.compare, corpus_iterator(open(key_file, 'r')),
+                            corpus_iterator(open(output_file, 'r')))
+            compare_secs.append(secs)
+    finally:
+        os.remove(output_file)
+    results['tag_file'] = {
+        'tag_file_secs': min(tag_secs),
+        'tokens_per_sec': dev_tokens / min(tag_secs),
+    }
+    results['compare'] = {
+        'compare_secs': min(compare_secs),
+        'tokens_per_sec': dev_tokens / min(compare_secs),
+    }
+    results['peak_rss_kb'] = peak_rss_kb()
+    return results
+
+def flatten(results, prefix=''):
+    ''' Flatten nested result dictionaries to {"decode.p50_ms": 0.01, ...},
+        keeping only the numeric metrics
+    '''
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and key not in ('repeat', 'sentences'):
+            metrics[prefix + key] = value
+    return metrics
+
+def find_regressions(results, baseline, threshold, min_secs=0.05):
+    ''' Compare results to baseline and return a list of (metric, baseline,
+        result) for each aggregate metric that is worse by more than
+        threshold (a fraction), and *_secs metrics also by more than
+        min_secs seconds; metrics under UNGATED_PREFIXES are skipped.
+        tokens_per_sec metrics are better when higher, all other metrics
+        (times, latencies, memory) are better when lower.
+    '''
+    current = flatten(results)
+    regressions = []
+    for metric, base in sorted(flatten(baseline).items()):
+        if metric not in current or base <= 0:
+            continue
+        if [prefix for prefix in UNGATED_PREFIXES if metric.startswith(prefix)]:
+            continue
+        value = current[metric]
+        if metric.endswith('tokens_per_sec'):
+            worse = value < base * (1 - threshold)
+        else:
+            worse = value > base * (1 + threshold)
+        if metric.endswith('_secs') and value - base <= min_secs:
+            worse = False
+        if worse:
+            regressions.append((metric, base, value))
+    return regressions
+
+def print_results(results):
+    ''' Output a table of the benchmark results
+    '''
+    for metric, value in sorted(flatten(results).items()):
+        print '%-45s %14.4f' % (metric, value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark load, decode and evaluation throughput')
+    parser.add_argument('--counts', default='gene.counts', help='tag counts file')
+    parser.add_argument('--dev', default='gene.dev', help='file tagged end-to-end by tag_file')
+    parser.add_argument('--key', default='gene.key', help='gold standard for the dev file')
+    parser.add_argument('--test', default='gene.test', help='file used for per-sentence decoding')
+    parser.add_argument('--engine', default='viterbi', choices=ENGINES)
+    parser.add_argument('--repeat', type=int, default=3, help='number of passes over each file')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to (JSON)')
+    parser.add_argument('--baseline', help='results file (JSON) to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which a metric may be worse than the baseline')
+    parser.add_argument('--min-secs', type=float, default=0.05,
+                        help='seconds by which a phase timing may be worse than the baseline regardless of --threshold')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.counts, args.dev, args.key, args.test, args.engine, args.repeat)
+    print_results(results)
+    output = open(args.output, 'w')
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.close()
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline, 'r'))
+        regressions = find_regressions(results, baseline, args.threshold, args.min_secs)
+        for metric, base, value in regressions:
+            print 'REGRESSION %s: %.4f -> %.4f' % (metric, base, value)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions against %s (threshold %.0f%%)' % (args.baseline, args.threshold * 100)
@@ -0,0 +1,73 @@
+import json, socket, httplib
+
+'''
+Client library for server.py:
+
+    client = TaggerClient(port=8642)    # or TaggerClient(socket_path='/tmp/gene_tagger.sock')
+    tags, log_prob = client.tag(['BACKGROUND', ':', 'Ischemic', 'heart', 'disease'])
+    results = client.tag_many(sentences)
+'''
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    ''' HTTPConnection over a Unix socket
+    '''
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class TaggerClient(object):
+    ''' Tags sentences with a running tagging server over one keep-alive
+        connection (use one client per thread)
+    '''
+
+    def __init__(self, port=8642, host='127.0.0.1', socket_path=None, timeout=30):
+        if socket_path is not None:
+            self.connection = UnixHTTPConnection(socket_path, timeout)
+        else:
+            self.connection = httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, data=None):
+        body = data is not None and json.dumps(data) or None
+        headers = {'Content-Type': 'application/json'}
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            result = json.loads(response.read())
+        except (httplib.HTTPException, socket.error):
+            # Reconnect once if the server closed the keep-alive connection
+            self.connection.close()
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            result = json.loads(response.read())
+        if response.status != 200:
+            raise Exception('Tagging server error %i: %s' % (response.status, result.get('error')))
+        return result
+
+    def tag_many(self, sentences):
+        ''' Tag a list of sentences (lists of words) and return a list of
+            (tags, log_prob) tuples
+        '''
+        results = self.request('POST', '/tag', {'sentences': sentences})['results']
+        return [([tag.encode('utf-8') for tag in result['tags']], result['log_prob']) for result in results]
+
+    def tag(self, sentence):
+        ''' Tag one sentence and return the tuple (tags, log_prob)
+        '''
+        return self.tag_many([sentence])[0]
+
+    def stats(self):
+        ''' Return the server's tagger and batching statistics
+        '''
+        return self.request('GET', '/stats')
+
+    def close(self):
+        self.connection.close()
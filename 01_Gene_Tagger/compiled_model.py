@@ -0,0 +1,205 @@
+import math, mmap, struct, sys, zlib
+from array import array
+
+NEG_INF = float('-inf')
+
+# Binary file format (all integers and floats little-endian):
+#   header:  MAGIC, then HEADER_FORMAT fields (see save)
+#   payload: tags ('\n' separated), words ('\n' separated), zero padding to a
+#            multiple of 8 bytes, log_q (T*T*T doubles), log_e ((V+1)*T doubles)
+MAGIC = 'GTAGCMPL'
+FORMAT_VERSION = 2
+HEADER_FORMAT = '<8sIIIIIIII20s20sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+class CompiledModel(object):
+    ''' Integer-ID form of a Tagger's (rare-folded) counts, used by the decoders.
+        Tags and words are interned to dense IDs and the log probabilities are
+        stored in flat arrays indexed by those IDs:
+            log_q[(w*T + u)*T + v] = log q(v|w, u)
+            log_e[word_id*T + v]   = log e(word|v)
+        Tag ID 0 is the '*' start tag and tag ID T-1 is the STOP tag; the
+        trained tags are 1 .. T-2. Word ID V (one past the vocabulary) is the
+        unknown word, which no tag emits. Words with an ID below n_frequent
+        are frequent words; the remaining IDs are RARE keywords.
+        word_tags[word_id] is the tuple of tag IDs that emit the word (the
+        tag dictionary used to prune the decoder's states).
+    '''
+
+    def __init__(self, tags, words, n_frequent, log_q, log_e):
+        self.tags = tags
+        self.words = words
+        self.n_frequent = n_frequent
+        self.log_q = log_q
+        self.log_e = log_e
+        self.T = len(tags)
+        self.V = len(words)
+        self.START = 0
+        self.STOP = self.T - 1
+        self.tag_ids = dict((tag, i) for i, tag in enumerate(tags))
+        self.word_ids = dict((word, i) for i, word in enumerate(words))
+        self.word_tags = self.build_word_tags()
+
+    def build_word_tags(self):
+        ''' Return the list of the tuple of tag IDs with a nonzero emission
+            probability for each word ID (words share equal tuples)
+        '''
+        T = self.T
+        log_e = self.log_e
+        shared = {}
+        word_tags = []
+        for i in range(self.V+1):
+            tags = tuple([v for v in range(1, T-1) if log_e[i*T + v] != NEG_INF])
+            word_tags.append(shared.setdefault(tags, tags))
+        return word_tags
+
+    @classmethod
+    def from_tagger(cls, tagger):
+        ''' Compile the counts of the given Tagger. Must be run after
+            read_tag_count_file and flag_rare_words.
+        '''
+        tags = ['*'] + list(tagger.trained_tag_counts.keys()) + ['STOP']
+        T = len(tags)
+
+        # Only frequent words and the RARE keywords can be looked up by the decoder
+        words = sorted(word for word, count in tagger.trained_word_counts.items()
+                       if count >= tagger.rare_cnt_threshold)
+        n_frequent = len(words)
+        words.extend(keyword for keyword in tagger.category_keywords
+                     if 0 < tagger.trained_word_counts.get(keyword, 0) < tagger.rare_cnt_threshold)
+
+        log_q = array('d', [NEG_INF]) * (T*T*T)
+        for w in range(T):
+            for u in range(T):
+                for v in range(T):
+                    prob = tagger.get_trigram_prob(tags[v], tags[w], tags[u])
+                    if prob > 0:
+                        log_q[(w*T + u)*T + v] = math.log(prob)
+
+        log_e = array('d', [NEG_INF]) * ((len(words)+1)*T)
+        for v in range(1, T-1):
+            tag_cnt = tagger.trained_tag_counts[tags[v]]
+            emissions = tagger.emission_counts[tags[v]]
+            for i, word in enumerate(words):
+                emit_cnt = emissions.get(word, 0)
+                if emit_cnt > 0:
+                    log_e[i*T + v] = math.log(float(emit_cnt)/tag_cnt)
+        return cls(tags, words, n_frequent, log_q, log_e)
+
+    def get_word_id(self, word):
+        ''' Return the ID of the given (normalized) word, or V if it is unknown
+        '''
+        return self.word_ids.get(word, self.V)
+
+    def is_frequent(self, word):
+        ''' Return True if the given word was seen at least rare_cnt_threshold
+            times in training (ie, it is decoded as itself)
+        '''
+        return self.word_ids.get(word, self.V) < self.n_frequent
+
+    def save(self, filename, rare_cnt_threshold, source_checksum, categories_checksum, n=3):
+        ''' Write the model to filename in the binary format described above.
+            @param int rare_cnt_threshold. threshold used to fold rare words
+            @param string source_checksum. sha1 digest of the counts file
+            @param string categories_checksum. sha1 digest of the RARE word
+                categories (see Tagger.categories_checksum)
+            @param int n. n-gram order of the model
+        '''
+        tags_blob = '\n'.join(self.tags)
+        words_blob = '\n'.join(self.words)
+        padding = '\0' * (-(HEADER_SIZE + len(tags_blob) + len(words_blob)) % 8)
+        log_q = array('d', self.log_q)
+        log_e = array('d', self.log_e)
+        if sys.byteorder == 'big':
+            log_q.byteswap()
+            log_e.byteswap()
+        payload = tags_blob + words_blob + padding + log_q.tostring() + log_e.tostring()
+        header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, n, rare_cnt_threshold,
+                             self.T, self.V, self.n_frequent, len(tags_blob), len(words_blob),
+                             source_checksum, categories_checksum, zlib.crc32(payload) & 0xffffffff)
+        try:
+            file = open(filename, 'wb')
+        except:
+            raise Exception('Cannot open file: %s' % filename)
+        file.write(header)
+        file.write(payload)
+        file.close()
+
+    @classmethod
+    def load(cls, filename):
+        ''' Memory-map a model written by save() and return the tuple
+            (model, metadata) where metadata is a dictionary with the keys
+            'n', 'rare_cnt_threshold', 'source_checksum' and 'categories_checksum'.
+        '''
+        try:
+            file = open(filename, 'rb')
+        except:
+            raise Exception('Cannot open file: %s' % filename)
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        try:
+            return cls.from_buffer(data, filename)
+        finally:
+            data.close()
+
+    @classmethod
+    def from_buffer(cls, data, name='<buffer>'):
+        ''' Parse a model in the binary format from a buffer (ie, an mmap).
+            The probability tables are copied out of the buffer in one block each.
+        '''
+        layout = read_layout(data, name)
+        if zlib.crc32(data[layout['offset']:layout['end']]) & 0xffffffff != layout['crc']:
+            raise Exception('Compiled model is truncated or corrupt: %s' % name)
+
+        tags = data[layout['offset']:layout['words_offset']].split('\n')
+        words = data[layout['words_offset']:layout['words_end']].split('\n') if layout['V'] else []
+        log_q = array('d')
+        log_q.fromstring(data[layout['q_offset']:layout['e_offset']])
+        log_e = array('d')
+        log_e.fromstring(data[layout['e_offset']:layout['end']])
+        if sys.byteorder == 'big':
+            log_q.byteswap()
+            log_e.byteswap()
+        return (cls(tags, words, layout['n_frequent'], log_q, log_e), layout['metadata'])
+
+
+def read_layout(data, name='<buffer>'):
+    ''' Check the header of a model in the binary format and return the
+        offsets of its sections in data (with the header fields T, V,
+        n_frequent and crc, and the load metadata)
+    '''
+    if len(data) < HEADER_SIZE or data[:len(MAGIC)] != MAGIC:
+        raise Exception('Not a compiled tagger model: %s' % name)
+    (magic, version, n, rare_cnt_threshold, T, V, n_frequent, tags_len, words_len,
+     source_checksum, categories_checksum, crc) = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if version != FORMAT_VERSION:
+        raise Exception('Unsupported compiled model version %i (expected %i): %s'
+                        % (version, FORMAT_VERSION, name))
+    offset = HEADER_SIZE
+    q_offset = offset + tags_len + words_len
+    q_offset += -q_offset % 8
+    e_offset = q_offset + T*T*T*8
+    end = e_offset + (V+1)*T*8
+    if len(data) != end:
+        raise Exception('Compiled model is truncated or corrupt: %s' % name)
+    return {
+        'T': T,
+        'V': V,
+        'n_frequent': n_frequent,
+        'crc': crc,
+        'offset': offset,
+        'words_offset': offset + tags_len,
+        'words_end': offset + tags_len + words_len,
+        'q_offset': q_offset,
+        'e_offset': e_offset,
+        'end': end,
+        'metadata': {
+            'n': n,
+            'rare_cnt_threshold': rare_cnt_threshold,
+            'source_checksum': source_checksum,
+            'categories_checksum': categories_checksum,
+        },
+    }
@@ -4,8 +4,14 @@ __author__="Daniel Bauer <bauer@cs.columbia.edu>"
 __date__ ="$Sep 12, 2011"
 
 import sys
+import os
 from collections import defaultdict
 import math
+import getopt
+import heapq
+import tempfile
+import multiprocessing
+from StringIO import StringIO
 
 """
 Count n-gram frequencies in a data file and write counts to
@@ -73,6 +79,95 @@ def get_ngrams(sent_iterator, n):
          for n_gram in ngrams: #Return one n-gram at a time
             yield n_gram        
 
+def corpus_chunks(corpus_file, chunk_size):
+    """
+    Split the corpus file at sentence boundaries. Return an iterator whose
+    elements are strings holding the lines of (at most) chunk_size
+    sentences, each sentence terminated by a blank line. Like
+    sentence_iterator, stop at the first blank line that does not end a
+    sentence (a leading blank line or two blank lines in a row), so that
+    the parallel and external counts match the serial ones.
+    """
+    lines = []
+    sentences = 0
+    in_sentence = False
+    l = corpus_file.readline()
+    while l:
+        if l.strip():
+            lines.append(l)
+            in_sentence = True
+        elif not in_sentence: # Got empty input stream
+            sys.stderr.write("WARNING: Got empty input file/stream.\n")
+            break
+        else: # End of a sentence
+            lines.append("\n")
+            in_sentence = False
+            sentences += 1
+            if sentences == chunk_size:
+                yield "".join(lines)
+                lines = []
+                sentences = 0
+        l = corpus_file.readline()
+    if lines:
+        if lines[-1].strip(): # The last line was not blank
+            lines.append("\n")
+        yield "".join(lines)
+
+def count_chunk(args):
+    """
+    Count the n-grams and emissions of one corpus chunk (see corpus_chunks).
+    Run in the worker processes of Hmm.train_parallel.
+    """
+    n, chunk = args
+    counter = Hmm(n)
+    counter.train(StringIO(chunk))
+    return counter
+
+def write_run(entries, directory=None):
+    """
+    Write (key, count) tuples, sorted by key, to a new run file in directory
+    (the system temp directory by default) and return its name. Each line
+    holds a key and its count separated by a tab.
+    """
+    handle, filename = tempfile.mkstemp(prefix="count_freqs.", suffix=".run", dir=directory)
+    run_file = os.fdopen(handle, "w", 1 << 16)
+    try:
+        for key, count in entries:
+            run_file.write("%s\t%i\n" % (key, count))
+    finally:
+        run_file.close()
+    return filename
+
+def read_run(filename):
+    """
+    Return an iterator over the (key, count) tuples of a run file (see
+    write_run), in file order.
+    """
+    run_file = open(filename, "r", 1 << 16)
+    try:
+        for line in run_file:
+            key, tab, count = line[:-1].rpartition("\t")
+            yield key, int(count)
+    finally:
+        run_file.close()
+
+def merge_runs(runs):
+    """
+    Streaming k-way merge of sorted iterators over (key, count) tuples.
+    Return an iterator over the (key, total count) of each key, sorted by key.
+    """
+    last_key = None
+    total = 0
+    for key, count in heapq.merge(*runs):
+        if key != last_key:
+            if last_key is not None:
+                yield last_key, total
+            last_key = key
+            total = 0
+        total += count
+    if last_key is not None:
+        yield last_key, total
+
 
 class Hmm(object):
     """
@@ -90,8 +185,14 @@ class Hmm(object):
         """
         Count n-gram frequencies and emission probabilities from a corpus file.
         """
-        ngram_iterator = \
-            get_ngrams(sentence_iterator(simple_conll_corpus_iterator(corpus_file)), self.n)
+        self.train_sentences(sentence_iterator(simple_conll_corpus_iterator(corpus_file)))
+
+    def train_sentences(self, sent_iterator):
+        """
+        Count n-gram frequencies and emission probabilities from an iterator
+        over sentences, each a list of (word, ne_tag) tuples.
+        """
+        ngram_iterator = get_ngrams(sent_iterator, self.n)
 
         for ngram in ngram_iterator:
             #Sanity check: n-gram we get from the corpus stream needs to have the right length
@@ -109,6 +210,109 @@ class Hmm(object):
             if ngram[-2][0] is None: # this is the first n-gram in a sentence
                 self.ngram_counts[self.n - 2][tuple((self.n - 1) * ["*"])] += 1
 
+    def update(self, sentences):
+        """
+        Add the counts of the given sentences (lists of (word, ne_tag) tuples)
+        to this Hmm. Return an Hmm holding only the added counts, which can be
+        passed to Tagger.apply_delta.
+        """
+        delta = Hmm(self.n)
+        delta.train_sentences(iter(sentences))
+        self.merge(delta)
+        return delta
+
+    def train_parallel(self, corpus_file, workers, chunk_size=1000):
+        """
+        Count n-gram frequencies and emission probabilities from a corpus file
+        using a pool of worker processes. The corpus is split into chunks of
+        chunk_size sentences, each chunk is counted by a worker and the partial
+        counts are merged into this Hmm.
+        """
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunks = ((self.n, chunk) for chunk in corpus_chunks(corpus_file, chunk_size))
+            for counter in pool.imap_unordered(count_chunk, chunks):
+                self.merge(counter)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def train_external(self, corpus_file, output, max_entries=1000000, directory=None, fan_in=64):
+        """
+        Count a corpus too large to count in memory and write the counts to
+        the output file object, in the format of write_counts (sorted by
+        count type, then n-gram or tag and word).
+        Counts are kept in memory until they hold more than max_entries
+        distinct emissions and n-grams, then spilled to a sorted run file in
+        directory (see write_run). The runs are combined by a streaming k-way
+        merge, so peak memory depends on max_entries, not on the size of the
+        corpus. At most fan_in runs are merged at once; when there are more,
+        they are first merged into a single run. The counts are not kept in
+        this Hmm.
+        """
+        runs = []
+        try:
+            for sentence in sentence_iterator(simple_conll_corpus_iterator(corpus_file)):
+                self.train_sentences(iter([sentence]))
+                if self.count_entries() > max_entries:
+                    runs.append(write_run(self.sorted_entries(), directory))
+                    self.clear()
+                    if len(runs) == fan_in:
+                        merged = write_run(merge_runs([read_run(run) for run in runs]), directory)
+                        for run in runs:
+                            os.remove(run)
+                        runs = [merged]
+            # The counts left in memory are the last run
+            entries = merge_runs([read_run(run) for run in runs] + [iter(self.sorted_entries())])
+            for key, count in entries:
+                output.write("%i %s\n" % (count, key))
+        finally:
+            for run in runs:
+                os.remove(run)
+            self.clear()
+
+    def count_entries(self):
+        """
+        Return the number of distinct emissions and n-grams counted.
+        """
+        return len(self.emission_counts) + sum(len(counts) for counts in self.ngram_counts)
+
+    def sorted_entries(self):
+        """
+        Return the counts as a list of (key, count) tuples sorted by key, where
+        key is a line of write_counts without its count (ie, "WORDTAG O the").
+        """
+        entries = [("WORDTAG %s %s" % (ne_tag, word), count)
+                   for (word, ne_tag), count in self.emission_counts.iteritems()]
+        for i in xrange(self.n):
+            entries.extend([("%i-GRAM %s" % (i+1, " ".join(ngram)), count)
+                            for ngram, count in self.ngram_counts[i].iteritems()])
+        entries.sort()
+        return entries
+
+    def clear(self):
+        """
+        Drop all counts.
+        """
+        self.emission_counts = defaultdict(int)
+        self.ngram_counts = [defaultdict(int) for i in xrange(self.n)]
+
+    def merge(self, other):
+        """
+        Add the counts of another Hmm of the same order to this one.
+        """
+        assert other.n == self.n, "Cannot merge %i-gram counts into %i-gram counts" % (other.n, self.n)
+        for emission, count in other.emission_counts.iteritems():
+            self.emission_counts[emission] += count
+        for i in xrange(self.n):
+            for ngram, count in other.ngram_counts[i].iteritems():
+                self.ngram_counts[i][ngram] += count
+        self.all_states.update(other.all_states)
+        return self
+
     def write_counts(self, output, printngrams=[1,2,3]):
         """
         Writes counts to the output file object.
@@ -150,25 +354,53 @@ class Hmm(object):
 
 def usage():
     print """
-    python count_freqs.py [input_file] > [output_file]
+    python count_freqs.py [-w workers | -m max_entries [-t tmp_dir]] [input_file] > [output_file]
         Read in a gene tagged training input file and produce counts.
+        With -w, count the corpus in parallel with that many processes.
+        With -m, hold at most max_entries counts in memory, spilling the
+        rest to sorted run files in tmp_dir (for corpora larger than memory).
+        In every mode, counting stops at a leading blank line or at two
+        blank lines in a row.
     """
 
 if __name__ == "__main__":
 
-    if len(sys.argv)!=2: # Expect exactly one argument: the training data file
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:m:t:", ["workers=", "max-entries=", "tmp-dir="])
+        workers = 1
+        max_entries = None
+        tmp_dir = None
+        for opt, value in opts:
+            if opt in ("-w", "--workers"):
+                workers = int(value)
+            elif opt in ("-m", "--max-entries"):
+                max_entries = int(value)
+            else:
+                tmp_dir = value
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+
+    if len(args)!=1 or (workers > 1 and max_entries): # Expect exactly one argument: the training data file
         usage()
         sys.exit(2)
 
     try:
-        input = file(sys.argv[1],"r")
+        input = file(args[0],"r")
     except IOError:
-        sys.stderr.write("ERROR: Cannot read inputfile %s.\n" % arg)
+        sys.stderr.write("ERROR: Cannot read inputfile %s.\n" % args[0])
         sys.exit(1)
     
     # Initialize a trigram counter
     counter = Hmm(3)
+    if max_entries:
+        # Count and write the counts in bounded memory
+        counter.train_external(input, sys.stdout, max_entries, tmp_dir)
+        sys.exit(0)
     # Collect counts
-    counter.train(input)
+    if workers > 1:
+        counter.train_parallel(input, workers)
+    else:
+        counter.train(input)
     # Write the counts
     counter.write_counts(sys.stdout)
@@ -0,0 +1,28 @@
+from lru_cache import LRUCache
+from instrumentation import new_counters
+
+
+class DecodeContext(object):
+    ''' The mutable state of decoding with one CompiledModel: the token
+        cache, the instrumentation counters and the pi() memo of the
+        'recursive' engine. The model itself is only read while decoding,
+        so any number of contexts (ie, one per thread, see
+        Tagger.get_context) can decode with one model at once, without
+        locks, and forked workers share the model's pages.
+    '''
+
+    def __init__(self, model, token_cache_size=50000):
+        self.model = model
+        # token_cache maps a raw word to the Tagger.get_token tuple
+        self.token_cache = LRUCache(token_cache_size)
+        # counters is updated in place, never replaced (see Tagger.stats)
+        self.counters = new_counters()
+        self.pi_cache = {}
+
+    def reset(self, model):
+        ''' Decode with another model: drop the cached tokens (they point
+            into the previous model's tables), keeping the counters
+        '''
+        self.model = model
+        self.token_cache.clear()
+        self.pi_cache = {}
@@ -4,6 +4,8 @@ __author__="Daniel Bauer <bauer@cs.columbia.edu>"
 __date__ ="$Sep 29, 2011"
 
 import sys
+import time
+from itertools import izip
 
 
 """
@@ -20,6 +22,10 @@ will generate a table of results like this:
 		 precision 	recall 		F1-Score
     GENE:	 0.433367	0.231270	0.301593
 
+Several prediction files can be scored in one pass over the gold standard:
+
+    python eval_gene_tagger.py gene_dev.key output1.dat output2.dat ...
+
 Adopted from original named entity evaluation.
 
 """
@@ -29,6 +35,8 @@ def corpus_iterator(corpus_file, with_logprob = False):
     Get an iterator object over the corpus file. The elements of the
     iterator contain (word, ne_tag) tuples. Blank lines, indicating
     sentence boundaries return (None, None).
+    If with_logprob is None, the lines have a log_prob field if the first
+    nonempty line ends in a number (ie, the output of main.py --scores).
     """
     l = corpus_file.readline()    
     tagfield = with_logprob and -2 or -1
@@ -37,6 +45,9 @@ def corpus_iterator(corpus_file, with_logprob = False):
         while l:
             line = l.strip()
             if line: # Nonempty line
+                if with_logprob is None: # Detect the format on the first line
+                    with_logprob = is_logprob_line(line)
+                    tagfield = with_logprob and -2 or -1
                 # Extract information from line.
                 # Each line has the format
                 # word ne_tag [log_prob]
@@ -55,6 +66,82 @@ def corpus_iterator(corpus_file, with_logprob = False):
         sys.exit(1)
 
 
+def is_logprob_line(line):
+    """
+    Return True if the line has the format "word ne_tag log_prob".
+    """
+    fields = line.split()
+    if len(fields) < 3:
+        return False
+    try:
+        float(fields[-1])
+    except ValueError:
+        return False
+    return True
+
+
+def tagged_iterator(sentences, tagged):
+    """
+    Get an iterator over decoded sentences in the same format as
+    corpus_iterator: (word, ne_tag) tuples, and (None, None) after each
+    sentence. sentences and tagged are iterables over the lists of words
+    and the lists of their tags.
+    """
+    for sentence, tags in izip(sentences, tagged):
+        for word, ne_tag in izip(sentence, tags):
+            yield word, ne_tag
+        yield (None, None)
+
+
+def tagged_sentences(corpus):
+    """
+    Group the (word, ne_tag) tuples of a corpus_iterator or tagged_iterator
+    into sentences, and get an iterator over (words, ne_tags) tuples of lists.
+    """
+    words = []
+    ne_tags = []
+    for word, ne_tag in corpus:
+        if word is None:
+            yield words, ne_tags
+            words = []
+            ne_tags = []
+        else:
+            words.append(word)
+            ne_tags.append(ne_tag)
+    if words:
+        yield words, ne_tags
+
+
+# NE type of each tag seen by get_spans (ie, "I-GENE" -> "GENE")
+tag_types = {}
+
+def get_spans(ne_tags, offset=0):
+    """
+    Return the set of named entities in a sentence as (start, end, type)
+    tuples, where start and end (exclusive) are token positions plus offset.
+    Entities start and end where Evaluator.compare starts and ends them: an
+    entity starts at a B tag, or at an I tag that does not continue an entity
+    of the same type, and ends before an O or B tag, an I tag of another type
+    or the end of the sentence.
+    """
+    spans = set()
+    curr_type = None
+    curr_start = None
+    for i, ne_tag in enumerate(ne_tags):
+        ne_type = tag_types.get(ne_tag)
+        if ne_type is None:
+            ne_type = tag_types[ne_tag] = ne_tag.split("-")[-1]
+        if curr_type is not None and (ne_tag[0] in "OB" or ne_type != curr_type):
+            spans.add((offset + curr_start, offset + i, curr_type))
+            curr_type = None
+        if ne_tag[0] == "B" or (ne_tag[0] == "I" and curr_type is None):
+            curr_start = i
+            curr_type = ne_type
+    if curr_type is not None:
+        spans.add((offset + curr_start, offset + len(ne_tags), curr_type))
+    return spans
+
+
 class NeTypeCounts(object):
     """
     Stores true/false positive/negative counts for each NE type.
@@ -190,6 +277,49 @@ class Evaluator(object):
                 curr_pred_type = pred_type
             total += 1
 
+    def add_spans(self, gold_spans, pred_spans):
+        """
+        Count the true positives (entities in both sets of spans), false
+        positives (predicted entities not in the gold standard) and false
+        negatives (gold standard entities not predicted), as compare does.
+        True negatives are not counted.
+        """
+        if gold_spans == pred_spans:
+            correct = gold_spans
+        else:
+            correct = gold_spans & pred_spans
+            for start, end, ne_type in pred_spans - correct:
+                self.fp += 1
+                self.class_counts[ne_type].fp += 1
+            for start, end, ne_type in gold_spans - correct:
+                self.fn += 1
+                self.class_counts[ne_type].fn += 1
+        for start, end, ne_type in correct:
+            self.tp += 1
+            self.class_counts[ne_type].tp += 1
+
+    def get_scores(self, c="GENE"):
+        """
+        Return the tuple (precision, recall, F1-Score) for NE class c, computed
+        the same way as in print_scores.
+        """
+        c_tp = self.class_counts[c].tp
+        c_fp = self.class_counts[c].fp
+        c_fn = self.class_counts[c].fn
+        if (c_tp + c_fn) == 0:
+            c_rec = 1
+        else:
+            c_rec = c_tp / float(c_tp + c_fn)
+        if (c_tp + c_fp) == 0:
+            c_prec = 1
+        else:
+            c_prec = c_tp / float(c_tp + c_fp)
+        if c_prec + c_rec == 0:
+            fscore = 0
+        else:
+            fscore = (2*c_prec * c_rec)/(c_prec + c_rec)
+        return c_prec, c_rec, fscore
+
     def print_scores(self):
         """
         Output a table with accuracy, precision, recall and F1 score. 
@@ -251,20 +381,113 @@ class Evaluator(object):
             print "%s:\t %f\t%f\t%f" % (c, c_prec, c_rec, fscore)
 
 
+def compare_many(gold_standard, predictions):
+    """
+    Compare several predictions against a gold standard in a single pass
+    over it, and return one Evaluator per prediction. The gold standard and
+    each prediction are (word, ne_tag) iterators as for Evaluator.compare.
+    The entities of each gold standard sentence are extracted once and
+    intersected with those of each prediction.
+    """
+    evaluators = [Evaluator() for prediction in predictions]
+    predictions = [tagged_sentences(prediction) for prediction in predictions]
+    offset = 0
+    for gs_words, gs_tags in tagged_sentences(gold_standard):
+        gold_spans = get_spans(gs_tags, offset)
+        for i, (evaluator, prediction) in enumerate(izip(evaluators, predictions)):
+            pred_words, pred_tags = next(prediction, ([], []))
+            # Make sure words in both files match up
+            if pred_words != gs_words:
+                sys.stderr.write("Could not align gold standard and prediction %i in the sentence starting at token %i.\n"
+                                 % (i+1, offset+1))
+                sys.stderr.write("Gold standard: %s  Prediction file: %s\n" % (" ".join(gs_words), " ".join(pred_words)))
+                sys.exit(1)
+            if pred_tags == gs_tags:
+                evaluator.add_spans(gold_spans, gold_spans)
+            else:
+                evaluator.add_spans(gold_spans, get_spans(pred_tags, offset))
+        offset += len(gs_words) + 1
+    return evaluators
+
+
+def print_table(names, evaluators, c="GENE"):
+    """
+    Output one row of counts and scores for NE class c per evaluator.
+    """
+    width = max([len(name) for name in names] + [len("prediction")])
+    print "%-*s\tfound\texpected\tcorrect\tprecision\trecall\t\tF1-Score" % (width, "prediction")
+    for name, evaluator in izip(names, evaluators):
+        counts = evaluator.class_counts[c]
+        prec, rec, fscore = evaluator.get_scores(c)
+        print "%-*s\t%i\t%i\t\t%i\t%f\t%f\t%f" % (width, name, counts.tp + counts.fp, counts.tp + counts.fn,
+                                                  counts.tp, prec, rec, fscore)
+
+
+def beam_curve(key_file, input_file, counts_file, beams, repeat=3):
+    """
+    Tag input_file with beam search at each of the given beam widths (0 for
+    exact viterbi decoding) and print the F1-Score against key_file next to
+    the decoding speed, to choose an operating point. Each width is decoded
+    once untimed (warming the token cache; its tags are the ones scored)
+    and then timed repeat times: the speed is that of the fastest pass.
+    """
+    from tagger import Tagger
+    tagger = Tagger()
+    tagger.read_tag_count_file(counts_file)
+    tagger.flag_rare_words()
+    tagger.compile_model()
+    sentences = list(tagger.iter_sentences(file(input_file)))
+    tokens = sum(len(sentence) for sentence in sentences)
+
+    print "beam\ttokens/sec\tprecision \trecall \t\tF1-Score"
+    for beam in beams:
+        tagged = [tagger.get_sentence_tags(sentence, beam=beam or None)[0] for sentence in sentences]
+        pass_secs = []
+        for i in range(repeat):
+            start = time.time()
+            for sentence in sentences:
+                tagger.get_sentence_tags(sentence, beam=beam or None)
+            pass_secs.append(time.time() - start)
+        evaluator = Evaluator()
+        evaluator.compare(corpus_iterator(file(key_file)), tagged_iterator(sentences, tagged))
+        prec, rec, fscore = evaluator.get_scores()
+        print "%s\t%.0f\t\t%f\t%f\t%f" % (beam or "exact", tokens / max(min(pass_secs), 1e-9), prec, rec, fscore)
+
+
 def usage():
     sys.stderr.write("""
     Usage: python eval_gene_tagger.py [key_file] [prediction_file]
         Evaluate the gene-tagger output in prediction_file against
         the gold standard in key_file. Output accuracy, precision,
-        recall and F1-Score.\n""")
+        recall and F1-Score.
+
+    Usage: python eval_gene_tagger.py [key_file] [prediction_file] [prediction_file] ...
+        Evaluate several prediction files in one pass over key_file and
+        output a table of their precision, recall and F1-Score.
+
+    Usage: python eval_gene_tagger.py --beam-curve [key_file] [input_file] [counts_file] [beams]
+        Tag input_file with each beam width in the comma separated list
+        beams (default 1,2,3,4,8,0; 0 is exact decoding) and output the
+        F1-Score and tokens per second (fastest of 3 passes) of each.\n""")
 
 if __name__ == "__main__":
 
+    if len(sys.argv) in (5, 6) and sys.argv[1] == "--beam-curve":
+        beams = [int(b) for b in (len(sys.argv) == 6 and sys.argv[5] or "1,2,3,4,8,0").split(",")]
+        beam_curve(sys.argv[2], sys.argv[3], sys.argv[4], beams)
+        sys.exit(0)
+
+    if len(sys.argv) > 3:
+        predictions = [corpus_iterator(file(name), with_logprob = None) for name in sys.argv[2:]]
+        evaluators = compare_many(corpus_iterator(file(sys.argv[1])), predictions)
+        print_table(sys.argv[2:], evaluators)
+        sys.exit(0)
+
     if len(sys.argv)!=3:
         usage()
         sys.exit(1)
     gs_iterator = corpus_iterator(file(sys.argv[1]))
-    pred_iterator = corpus_iterator(file(sys.argv[2]), with_logprob = False)
+    pred_iterator = corpus_iterator(file(sys.argv[2]), with_logprob = None)
     evaluator = Evaluator()
     evaluator.compare(gs_iterator, pred_iterator)
     evaluator.print_scores()
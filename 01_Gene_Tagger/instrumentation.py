@@ -0,0 +1,76 @@
+import sys, time
+
+# Counters and timers kept by a Tagger when Tagger.instrument is True
+COUNTERS = [
+    'sentences',            # sentences decoded
+    'tokens',               # words decoded
+    'rare_word_fallbacks',  # words decoded as a RARE keyword
+    'states_visited',       # (u, v) states scored
+    'transition_lookups',   # q(v|w, u) lookups
+    'emission_lookups',     # e(word|v) lookups
+    'pi_cache_hits',        # pi_cache hits ('recursive' engine only)
+    'pi_cache_misses',      # pi_cache misses ('recursive' engine only)
+]
+TIMERS = [
+    'normalize_secs',       # mapping words to normalized words / word IDs
+    'decode_secs',          # decoding, not counting normalization
+    'io_secs',              # reading sentences and writing tags (tag_stream)
+]
+
+
+def new_counters():
+    ''' Return a dictionary with every counter and timer set to zero
+    '''
+    counters = dict((name, 0) for name in COUNTERS)
+    counters.update((name, 0.0) for name in TIMERS)
+    return counters
+
+
+def timed_iter(iterable, timers, name):
+    ''' Generate the items of iterable, adding the time spent producing them
+        to timers[name]
+    '''
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = iterator.next()
+        finally:
+            timers[name] += time.time() - start
+        yield item
+
+
+class ProgressReporter(object):
+    ''' Report tagging progress to a stream at most once every `interval`
+        seconds (never if interval is None), so the cost of reporting does
+        not grow with the number of sentences.
+    '''
+
+    def __init__(self, stream=sys.stderr, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.sentences = 0
+        self.tokens = 0
+        self.start = self.last = time.time()
+
+    def update(self, tokens):
+        ''' Record one more tagged sentence of `tokens` words
+        '''
+        self.sentences += 1
+        self.tokens += tokens
+        if self.interval is not None:
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.report(now)
+
+    def finish(self):
+        ''' Report the final totals
+        '''
+        if self.interval is not None:
+            self.report(time.time())
+
+    def report(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        self.stream.write('Tagged %i sentences (%i words, %.0f words/sec)\n'
+                          % (self.sentences, self.tokens, self.tokens / elapsed))
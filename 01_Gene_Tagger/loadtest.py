@@ -0,0 +1,65 @@
+import sys, time, argparse, threading
+from tagger import Tagger
+from client import TaggerClient
+from benchmark import percentile
+
+'''
+Load test for a running server.py: several client threads send the
+sentences of a file, one sentence per request, and the throughput and
+latency percentiles are reported:
+
+    python loadtest.py --port 8642 --clients 8 --requests 2000
+'''
+
+
+def client_thread(client, sentences, start, requests, latencies, errors):
+    ''' Send `requests` sentences (cycling through sentences from `start`),
+        appending the latency of each request to latencies
+    '''
+    for i in range(requests):
+        sentence = sentences[(start + i) % len(sentences)]
+        begin = time.time()
+        try:
+            client.tag(sentence)
+        except Exception, e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.time() - begin)
+    client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a running tagging server')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--socket', help='Unix socket of the server (instead of --port)')
+    parser.add_argument('--input', default='gene.dev', help='file of sentences to send')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--requests', type=int, default=2000, help='total requests to send')
+    args = parser.parse_args()
+
+    sentences = list(Tagger().iter_sentences(open(args.input, 'r')))
+    per_client = args.requests // args.clients
+    latencies = []
+    errors = []
+    threads = []
+    for c in range(args.clients):
+        client = TaggerClient(args.port, socket_path=args.socket)
+        threads.append(threading.Thread(target=client_thread,
+                                        args=(client, sentences, c * per_client, per_client, latencies, errors)))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    sent = per_client * args.clients
+    tokens = sum(len(sentences[i % len(sentences)]) for i in range(sent))
+    print 'Requests: %i (%i errors) from %i clients in %.2f secs' % (sent, len(errors), args.clients, elapsed)
+    print 'Throughput: %.0f sentences/sec, %.0f tokens/sec' % (len(latencies) / elapsed, tokens / elapsed)
+    print 'Latency: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000)
+    if errors:
+        print 'First error: %s' % errors[0]
+        sys.exit(1)
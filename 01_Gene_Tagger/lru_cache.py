@@ -0,0 +1,89 @@
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    ''' Bounded mapping that evicts the least recently used entry once it
+        holds maxsize entries, and counts its hits and misses.
+        Entries are kept in a circular doubly linked list of
+        [prev, next, key, value] links (most recently used last).
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def get(self, key, default=None):
+        ''' Return the value cached for key (marking it most recently used),
+            or default if key is not cached
+        '''
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # Move the link to the most recently used end of the list
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+        return link[VALUE]
+
+    def put(self, key, value):
+        ''' Cache value for key, evicting the least recently used entry if full
+        '''
+        if self.maxsize <= 0:
+            return
+        if key in self.links:
+            self.remove(key)
+        elif len(self.links) >= self.maxsize:
+            self.remove(self.root[NEXT][KEY])
+        root = self.root
+        last = root[PREV]
+        link = [last, root, key, value]
+        last[NEXT] = root[PREV] = self.links[key] = link
+
+    def remove(self, key):
+        ''' Drop the entry cached for key
+        '''
+        link = self.links.pop(key)
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def clear(self):
+        ''' Drop all entries (the hit and miss counts are kept)
+        '''
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+    def hit_rate(self):
+        ''' Fraction of lookups that were hits (0 if there were none)
+        '''
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits)/lookups
+
+    def stats(self):
+        ''' Return a dictionary with the size, maxsize, hits, misses and hit_rate
+        '''
+        return {
+            'size': len(self.links),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+        }
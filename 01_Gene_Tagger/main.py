@@ -1,18 +1,62 @@
-import os
-from tagger import Tagger
+import os, sys, argparse
+from tagger import Tagger, ENGINES
 
 if __name__ == '__main__':
-    print 'Begin Tagger main method'
+    parser = argparse.ArgumentParser(description='Tag each sentence of a file with gene tags')
+    parser.add_argument('--counts', default=os.getcwd() + r'/gene.counts',
+                        help='tag counts file produced by count_freqs.py')
+    parser.add_argument('--input', default=os.getcwd() + r'/gene.dev',
+                        help='file of sentences to tag (one word per line), or - for stdin')
+    parser.add_argument('--output', default=os.getcwd() + r'/gene_dev.p3.out',
+                        help='file to write the tagged sentences to, or - for stdout')
+    parser.add_argument('--engine', default='viterbi', choices=ENGINES,
+                        help='decoding engine')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes decoding sentences in parallel')
+    parser.add_argument('--max-cells', type=int, default=None,
+                        help='most lattice cells the checkpoint engine holds at once')
+    parser.add_argument('--beam', type=int, default=None,
+                        help='decode with beam search of this width instead of exact viterbi')
+    parser.add_argument('--scores', action='store_true',
+                        help='write the posterior log prob of each tag after it (requires numpy)')
+    parser.add_argument('--result-cache', metavar='FILE',
+                        help='keep decoded sentences in this file and reuse them across runs')
+    parser.add_argument('--result-cache-size', type=int, default=0,
+                        help='keep this many decoded sentences in memory and reuse them '
+                             '(10000 with --result-cache)')
+    parser.add_argument('--result-cache-disk-size', type=int, default=0,
+                        help='keep at most this many decoded sentences in the --result-cache file, '
+                             'emptying it when full (10 times --result-cache-size by default)')
+    parser.add_argument('--stats', action='store_true',
+                        help='collect decoding statistics and print them when done')
+    args = parser.parse_args()
+    # Keep stdout clean for the tagged sentences when writing to it
+    log = args.output == '-' and sys.stderr or sys.stdout
 
-    train_filename = os.getcwd() + r'/gene.train'
-    count_filename = os.getcwd() + r'/gene.counts'
-    dev_filename = os.getcwd() + r'/gene.dev'
-    output_filename = os.getcwd() + r'/gene_dev.p3.out'
+    print >> log, 'Begin Tagger main method'
 
     tagger = Tagger()
-    tagger.read_tag_count_file(count_filename)
+    tagger.read_tag_count_file(args.counts)
     tagger.flag_rare_words()
+    tagger.compile_model()
+    tagger.instrument = args.stats
+    if args.max_cells:
+        tagger.checkpoint_max_cells = args.max_cells
+    if args.result_cache or args.result_cache_size > 0:
+        tagger.enable_result_cache(args.result_cache_size > 0 and args.result_cache_size or 10000,
+                                   args.result_cache, args.result_cache_disk_size or None)
 
-    tagger.tag_file(dev_filename, output_filename)
+    if args.input == '-' or args.output == '-':
+        ifile = args.input == '-' and sys.stdin or open(args.input, 'r')
+        ofile = args.output == '-' and sys.stdout or open(args.output, 'w')
+        tagger.tag_stream(ifile, ofile, args.engine, args.workers, args.beam, args.scores)
+        ofile.flush()
+    else:
+        tagger.tag_file(args.input, args.output, args.engine, args.workers, args.beam, args.scores)
 
-    print 'Task complete'
+    if args.stats:
+        for name, value in sorted(tagger.stats().items()):
+            print >> log, '%s: %s' % (name, value)
+    tagger.close_result_cache()
+
+    print >> log, 'Task complete'
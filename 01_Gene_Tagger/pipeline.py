@@ -0,0 +1,102 @@
+import time, argparse, itertools
+from count_freqs import Hmm
+from tagger import Tagger, ENGINES, format_tagged
+from instrumentation import timed_iter
+from eval_gene_tagger import Evaluator, corpus_iterator, tagged_iterator
+
+'''
+Train, tag and evaluate in one process, without the intermediate counts and
+tagged files:
+
+    python pipeline.py --train gene.train --input gene.dev --key gene.key
+
+The counts of the training corpus are handed to the Tagger as an in-memory
+count_freqs.Hmm, and decoded sentences are scored by Evaluator.compare as
+they are produced. --counts-output and --output also write the counts and
+tagged files. The time spent in each stage is reported.
+'''
+
+
+def write_tagged(sentences, tagged, ofile):
+    ''' Generate the tags of each sentence, writing each tagged sentence to
+        file object ofile (in the format of Tagger.tag_file) on the way
+    '''
+    for sentence, tags in itertools.izip(sentences, tagged):
+        ofile.write(format_tagged(sentence, tags))
+        yield tags
+
+def run_pipeline(train_file, input_file, key_file, workers=1, engine='viterbi', beam=None,
+                 counts_output=None, output=None):
+    ''' Count train_file, tag input_file with the resulting model and score
+        the tags against key_file. Only writes the counts and tagged files
+        if counts_output or output is given.
+        @return tuple (evaluator, timings) where timings maps each stage to seconds
+    '''
+    timings = dict((stage, 0.0) for stage in ('count', 'build', 'tag', 'evaluate', 'write'))
+
+    # Count the training corpus
+    start = time.time()
+    hmm = Hmm(3)
+    if workers > 1:
+        hmm.train_parallel(file(train_file), workers)
+    else:
+        hmm.train(file(train_file))
+    timings['count'] = time.time() - start
+
+    if counts_output is not None:
+        start = time.time()
+        ofile = open(counts_output, 'w', 1 << 16)
+        hmm.write_counts(ofile)
+        ofile.close()
+        timings['write'] += time.time() - start
+
+    # Build the model from the in-memory counts
+    start = time.time()
+    tagger = Tagger()
+    tagger.read_hmm(hmm)
+    tagger.flag_rare_words()
+    tagger.compile_model()
+    timings['build'] = time.time() - start
+
+    # Decode and score the sentences as they stream past
+    start = time.time()
+    ifile = open(input_file, 'r')
+    sentences, pending = itertools.tee(tagger.iter_sentences(ifile))
+    tagged = timed_iter(tagger.tag_sentences(pending, engine, workers, beam=beam), timings, 'tag')
+    ofile = None
+    if output is not None:
+        sentences, written = itertools.tee(sentences)
+        ofile = open(output, 'w', 1 << 16)
+        tagged = timed_iter(write_tagged(written, tagged, ofile), timings, 'write')
+    evaluator = Evaluator()
+    evaluator.compare(corpus_iterator(file(key_file)), tagged_iterator(sentences, tagged))
+    ifile.close()
+    if ofile is not None:
+        ofile.close()
+    elapsed = time.time() - start
+    if output is not None:
+        # The write timer also covers the decoding it pulled through
+        timings['write'] -= timings['tag']
+    timings['evaluate'] = elapsed - timings['tag'] - timings['write']
+    return evaluator, timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train, tag and evaluate the gene tagger in one process')
+    parser.add_argument('--train', default='gene.train', help='training corpus (word tag per line)')
+    parser.add_argument('--input', default='gene.dev', help='file of sentences to tag')
+    parser.add_argument('--key', default='gene.key', help='gold standard tags of the input file')
+    parser.add_argument('--engine', default='viterbi', choices=ENGINES)
+    parser.add_argument('--beam', type=int, default=None, help='beam width (exact decoding if not given)')
+    parser.add_argument('--workers', type=int, default=1, help='processes counting and decoding in parallel')
+    parser.add_argument('--counts-output', help='also write the counts to this file')
+    parser.add_argument('--output', help='also write the tagged sentences to this file')
+    args = parser.parse_args()
+
+    evaluator, timings = run_pipeline(args.train, args.input, args.key, args.workers, args.engine,
+                                      args.beam, args.counts_output, args.output)
+    evaluator.print_scores()
+    print
+    for stage in ('count', 'build', 'tag', 'evaluate', 'write'):
+        print '%-10s %8.3f secs' % (stage, timings[stage])
+    print '%-10s %8.3f secs' % ('total', sum(timings.values()))
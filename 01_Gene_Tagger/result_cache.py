@@ -0,0 +1,121 @@
+import os, shelve, threading
+from lru_cache import LRUCache
+
+# shelve key holding the fingerprint of the model the on-disk results are for
+FINGERPRINT_KEY = '__fingerprint__'
+# Files a shelve named filename may be stored in, depending on the dbm module
+DISK_SUFFIXES = ['', '.db', '.dat', '.dir', '.bak']
+
+
+class ResultCache(object):
+    ''' Two-tier cache of decoded sentences: an in-memory LRU tier and an
+        optional on-disk tier (a shelve file) that survives restarts.
+        Results are only valid for one model: set_fingerprint empties both
+        tiers whenever the model fingerprint changes, so results of an
+        older counts file or rare_cnt_threshold are never returned.
+        The on-disk tier holds at most disk_maxsize sentences (10 times
+        maxsize by default): it is not an LRU, so once full it is emptied
+        and starts over. Emptying it recreates the file, as deleting the
+        entries of a shelve does not shrink it.
+        Lookups and updates hold a lock, so threads can share the cache.
+    '''
+
+    def __init__(self, maxsize=10000, filename=None, disk_maxsize=None):
+        self.memory = LRUCache(maxsize)
+        self.filename = filename
+        self.disk_maxsize = disk_maxsize or 10 * maxsize
+        self.disk = None
+        self.disk_size = 0
+        self.fingerprint = None
+        if filename is not None:
+            self.disk = shelve.open(filename)
+            self.fingerprint = self.disk.get(FINGERPRINT_KEY)
+            self.disk_size = max(len(self.disk) - 1, 0)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def set_fingerprint(self, fingerprint):
+        ''' Make fingerprint the model of the cached results, emptying the
+            cache if it held the results of another model
+        '''
+        if fingerprint == self.fingerprint:
+            return
+        with self.lock:
+            self.memory.clear()
+            self.fingerprint = fingerprint
+            self.reset_disk()
+
+    def get(self, key):
+        ''' Return the result cached for key, or None
+        '''
+        with self.lock:
+            value = self.memory.get(key)
+            if value is None and self.disk is not None:
+                value = self.disk.get(key)
+                if value is not None:
+                    self.disk_hits += 1
+                    self.memory.put(key, value)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.memory.put(key, value)
+            if self.disk is not None:
+                if key not in self.disk:
+                    if self.disk_size >= self.disk_maxsize:
+                        self.reset_disk()
+                    self.disk_size += 1
+                self.disk[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.reset_disk()
+
+    def reset_disk(self):
+        ''' Empty the on-disk tier by recreating its file, keeping only the
+            fingerprint. Called with the lock held.
+        '''
+        if self.disk is not None:
+            self.disk.close()
+            # dumbdbm ignores the 'n' flag, so remove the old files first
+            for suffix in DISK_SUFFIXES:
+                if os.path.exists(self.filename + suffix):
+                    os.remove(self.filename + suffix)
+            self.disk = shelve.open(self.filename, 'n')
+            self.disk[FINGERPRINT_KEY] = self.fingerprint
+            self.disk_size = 0
+
+    def sync(self):
+        ''' Write the on-disk tier to disk
+        '''
+        with self.lock:
+            if self.disk is not None:
+                self.disk.sync()
+
+    def close(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+
+    def stats(self):
+        ''' Return the hits (and how many of them came from disk), misses,
+            hit_rate, in-memory size and on-disk size of the cache
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+            'size': len(self.memory),
+            'maxsize': self.memory.maxsize,
+            'disk_size': self.disk_size,
+        }
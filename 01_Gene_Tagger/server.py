@@ -0,0 +1,288 @@
+import os, sys, time, json, signal, argparse, threading, itertools
+import Queue, SocketServer, BaseHTTPServer
+import tagger as tagger_module
+import shared_model
+from tagger import Tagger, ENGINES
+
+'''
+Long-running tagging server. Loads one Tagger once and tags sentences sent
+over localhost HTTP or a Unix socket:
+
+    python server.py --port 8642
+    python server.py --socket /tmp/gene_tagger.sock --model gene.bin
+    python server.py --port 8643 --shared-model gene
+
+POST /tag with the JSON body {"sentences": [["BACKGROUND", ":", ...], ...]}
+returns {"results": [{"tags": ["O", "O", ...], "log_prob": -81.2}, ...]}.
+GET /stats returns the batching and cache statistics, and the decoding
+counters and timers of the tagger if the server was started with --stats.
+
+Sentences of concurrent requests are grouped into micro-batches of up to
+--batch-size sentences (waiting at most --max-delay seconds to fill one)
+and each batch is decoded in one go, by this process or by a pool of
+--workers processes. See client.py for a client library.
+
+Servers started with the same --shared-model name share one copy of the
+model tables in shared memory: the first one publishes them, the others
+attach (see shared_model).
+'''
+
+
+def init_server_worker(tagger, engine, beam=None):
+    ''' Pool initializer of the --workers processes (see tagger.init_worker).
+        Workers ignore SIGTERM and SIGINT, which a service manager or the
+        terminal sends to the whole process group: a worker killed while
+        waiting for a task would hold the pool's task queue lock, and the
+        server's pool shutdown would hang on it. The server shuts the
+        workers down itself when it exits.
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tagger_module.init_worker(tagger, engine, beam)
+
+
+class PendingRequest(object):
+    ''' The sentences of one request, waiting for their batch to be decoded
+    '''
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise Exception(self.error)
+        return self.results
+
+
+class MicroBatcher(object):
+    ''' Collects the sentences of concurrent requests into batches and decodes
+        each batch on a single background thread.
+    '''
+
+    def __init__(self, tagger, engine='viterbi', beam=None, batch_size=64, max_delay=0.0, workers=1):
+        self.tagger = tagger
+        self.engine = engine
+        self.beam = beam
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        self.batches = 0
+        self.sentences = 0
+        self.pool = None
+        if workers > 1:
+            tagger.prepare_workers(engine, beam)
+            self.pool = tagger.start_pool(workers, init_server_worker, (tagger, engine, beam))
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, sentences):
+        ''' Queue the sentences of one request and wait for their results:
+            a list of (tags, log_prob) tuples
+        '''
+        request = PendingRequest(sentences)
+        self.queue.put(request)
+        return request.wait()
+
+    def next_batch(self):
+        ''' Block for the next request, then add queued requests to the batch
+            until it holds batch_size sentences or max_delay has passed (with
+            max_delay 0, only the requests that queued up while the previous
+            batch was decoded are added)
+        '''
+        batch = [self.queue.get()]
+        size = len(batch[0].sentences)
+        deadline = time.time() + self.max_delay
+        while size < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    request = self.queue.get(timeout=remaining)
+                else:
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.sentences)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # Each request is decoded on its own, so an error (ie, a sentence
+            # too long for the engine) only fails the request it came from
+            if self.pool is not None:
+                # All requests of the batch are in flight at once
+                pending = [self.pool.map_async(tagger_module.tag_sentence_worker, request.sentences)
+                           for request in batch]
+            else:
+                pending = [None] * len(batch)
+            for request, result in itertools.izip(batch, pending):
+                try:
+                    if result is not None:
+                        request.results = result.get()
+                    else:
+                        request.results = [self.tagger.get_sentence_tags(sentence, self.engine, self.beam)
+                                           for sentence in request.sentences]
+                except Exception, e:
+                    request.error = str(e)
+                request.done.set()
+            self.batches += 1
+            self.sentences += sum(len(request.sentences) for request in batch)
+
+    def close(self):
+        ''' Stop the worker processes once they finish their sentences. The
+            workers ignore SIGTERM (see init_server_worker), so the pool is
+            closed and joined, never terminated.
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'sentences': self.sentences,
+            'mean_batch_size': self.batches and float(self.sentences) / self.batches or 0.0,
+        }
+
+
+class TaggerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' HTTP/1.1 (keep-alive) handler for the /tag and /stats endpoints
+    '''
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response and send it in one write (see send_json), so
+    # Nagle's algorithm does not delay keep-alive responses
+    wbufsize = -1
+
+    def do_POST(self):
+        if self.path != '/tag':
+            return self.send_json(404, {'error': 'Unknown path: %s' % self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            sentences = body['sentences']
+            if not isinstance(sentences, list) or not all(isinstance(s, list) for s in sentences):
+                raise ValueError('sentences must be a list of lists of words')
+            sentences = [[word.encode('utf-8') for word in sentence] for sentence in sentences]
+        except (ValueError, KeyError, AttributeError), e:
+            return self.send_json(400, {'error': 'Bad request: %s' % e})
+        try:
+            results = self.server.batcher.submit(sentences)
+        except Exception, e:
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(200, {'results': [{'tags': tags, 'log_prob': log_prob} for tags, log_prob in results]})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.send_json(404, {'error': 'Unknown path: %s' % self.path})
+        stats = self.server.tagger.stats()
+        stats['batching'] = self.server.batcher.stats()
+        self.send_json(200, stats)
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(tagger, batcher, port=None, socket_path=None, verbose=False):
+    ''' Create a threading HTTP server on 127.0.0.1:port, or on the Unix
+        socket socket_path, that tags with the given MicroBatcher
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, TaggerRequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), TaggerRequestHandler)
+    server.tagger = tagger
+    server.batcher = batcher
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve gene tags from a resident Tagger')
+    parser.add_argument('--counts', default='gene.counts', help='tag counts file')
+    parser.add_argument('--model', help='compiled model (see Tagger.save_compiled) to load instead of --counts')
+    parser.add_argument('--shared-model', metavar='NAME',
+                        help='attach to (or publish) the model in the shared-memory segment NAME')
+    parser.add_argument('--port', type=int, default=8642, help='localhost HTTP port')
+    parser.add_argument('--socket', help='serve on this Unix socket instead of HTTP')
+    parser.add_argument('--engine', default='viterbi', choices=ENGINES)
+    parser.add_argument('--beam', type=int, default=None, help='beam width (exact decoding if not given)')
+    parser.add_argument('--batch-size', type=int, default=64, help='maximum sentences per micro-batch')
+    parser.add_argument('--max-delay', type=float, default=0.0,
+                        help='seconds to wait for more requests to fill a micro-batch')
+    parser.add_argument('--workers', type=int, default=1, help='processes decoding each micro-batch')
+    parser.add_argument('--stats', action='store_true',
+                        help='collect decoding statistics for GET /stats (slows decoding)')
+    parser.add_argument('--verbose', action='store_true', help='log each request')
+    args = parser.parse_args()
+    if args.engine == 'recursive' and not args.beam and (args.model or args.shared_model):
+        # A loaded or attached model has no counts for the recursive engine
+        parser.error('--engine recursive cannot decode with --model or --shared-model')
+
+    tagger = Tagger()
+    attached = False
+    if args.shared_model:
+        try:
+            tagger.attach_shared(args.shared_model)
+            attached = True
+        except Exception:
+            # Publish below if there is no segment (ie, its last holder
+            # removed it), but do not replace one this server cannot use
+            if os.path.exists(shared_model.segment_path(args.shared_model)):
+                raise
+    if not attached:
+        if args.model:
+            tagger.load_compiled(args.model)
+        else:
+            tagger.read_tag_count_file(args.counts)
+            tagger.flag_rare_words()
+            tagger.compile_model()
+        if args.shared_model:
+            tagger.publish_shared(args.shared_model)
+    tagger.instrument = args.stats
+    # Exit cleanly on SIGTERM too, so the shared model is released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    batcher = MicroBatcher(tagger, args.engine, args.beam, args.batch_size, args.max_delay, args.workers)
+    server = make_server(tagger, batcher, args.port, args.socket, args.verbose)
+    print >> sys.stderr, 'Serving on %s' % (args.socket or '127.0.0.1:%i' % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
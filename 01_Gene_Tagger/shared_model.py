@@ -0,0 +1,214 @@
+import os, sys, mmap, fcntl, ctypes, atexit, tempfile, zlib
+from array import array
+from bisect import bisect_left
+from compiled_model import CompiledModel, NEG_INF, read_layout
+
+'''
+Shared-memory store for compiled models. A model is published once under a
+name, as a file in the compiled model binary format (see CompiledModel.save)
+in /dev/shm, and any number of worker processes on the host attach to it:
+
+    shared_model.publish(tagger.compiled, 'gene', threshold, checksum, categories_checksum)
+    model, metadata = shared_model.attach('gene')
+
+An attached model reads its probability tables, word list and tag
+dictionary straight out of the shared mapping (no per-worker copy).
+Each attached process holds a shared flock on the segment as its reference;
+the process that detaches last (at exit, see detach) removes the segment.
+'''
+
+# Directory holding the shared segments (tmpfs on Linux)
+SHM_DIR = os.path.isdir('/dev/shm') and '/dev/shm' or tempfile.gettempdir()
+SEGMENT_PREFIX = 'gene_tagger.'
+
+# Models attached by this process, detached at exit
+attached = []
+
+
+def segment_path(name):
+    ''' Return the file of the shared segment with the given name
+    '''
+    if not name or '/' in name:
+        raise Exception('Invalid shared model name: %r' % name)
+    return os.path.join(SHM_DIR, SEGMENT_PREFIX + name)
+
+def publish(model, name, rare_cnt_threshold, source_checksum, categories_checksum, n=3):
+    ''' Write model to the shared segment name (replacing any older version:
+        processes attached to it keep their copy until they detach) and
+        attach this process to it
+        @return tuple (model, metadata) as for attach
+    '''
+    path = segment_path(name)
+    handle, temp_path = tempfile.mkstemp(prefix=SEGMENT_PREFIX, dir=SHM_DIR)
+    os.close(handle)
+    try:
+        model.save(temp_path, rare_cnt_threshold, source_checksum, categories_checksum, n)
+        os.chmod(temp_path, 0644)
+        # Readers never see a partly written segment
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return attach(name)
+
+def attach(name, verify=True):
+    ''' Map the shared segment name read-only (copy-on-write) and take a
+        reference on it. If verify is True the segment's checksum is checked.
+        @return tuple (model, metadata) where model is a SharedModel and
+            metadata as for CompiledModel.load
+    '''
+    path = segment_path(name)
+    for attempt in range(3):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            raise Exception('No shared model named %s (%s)' % (name, path))
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # The last holder may have removed (or a publisher replaced) the
+        # segment while we waited for the lock: attach to the current one
+        try:
+            current = os.stat(path).st_ino
+        except OSError:
+            current = None
+        if current == os.fstat(fd).st_ino:
+            break
+        os.close(fd)
+    else:
+        raise Exception('Shared model %s keeps changing, cannot attach' % name)
+
+    try:
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+        layout = read_layout(data, path)
+        if verify and zlib.crc32(data[layout['offset']:layout['end']]) & 0xffffffff != layout['crc']:
+            raise Exception('Compiled model is truncated or corrupt: %s' % path)
+        model = SharedModel(data, layout, path, fd)
+    except:
+        os.close(fd)
+        raise
+    if not attached:
+        atexit.register(detach_all)
+    attached.append(model)
+    return (model, layout['metadata'])
+
+def detach(model):
+    ''' Drop this process's reference on the segment of model, removing the
+        segment if no other process is attached. The model stays usable in
+        this process (the mapping outlives the segment file).
+    '''
+    if model.fd is None:
+        return
+    fd = model.fd
+    model.fd = None
+    if model in attached:
+        attached.remove(model)
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        # Another process still holds a reference
+        os.close(fd)
+        return
+    try:
+        # Only remove the segment if it was not replaced by a newer publish
+        if os.stat(model.path).st_ino == os.fstat(fd).st_ino:
+            os.remove(model.path)
+    except OSError:
+        pass
+    os.close(fd)
+
+def detach_all():
+    for model in list(attached):
+        detach(model)
+
+
+class SharedWords(object):
+    ''' Read-only word list of a shared model: words are sliced out of the
+        mapped '\\n' separated word list on demand, and looked up by binary
+        search (the frequent words are sorted, see CompiledModel.from_tagger)
+        instead of through a per-process dictionary.
+    '''
+
+    def __init__(self, data, start, end, n_frequent):
+        self.data = data
+        self.n_frequent = n_frequent
+        # starts[i] is the offset of word i in data (one past the last word
+        # for i = number of words), 4 bytes per word
+        self.starts = array('I')
+        if end > start:
+            position = start
+            while position != -1:
+                self.starts.append(position)
+                position = data.find('\n', position, end)
+                if position != -1:
+                    position += 1
+        self.starts.append(end + 1)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('word ID out of range')
+        return self.data[self.starts[i]:self.starts[i+1]-1]
+
+    def get(self, word, default=None):
+        ''' Return the ID of word, or default (like a word_ids dictionary)
+        '''
+        i = bisect_left(self, word, 0, self.n_frequent)
+        if i < self.n_frequent and self[i] == word:
+            return i
+        # The RARE keywords follow the (sorted) frequent words
+        for i in range(self.n_frequent, len(self)):
+            if self[i] == word:
+                return i
+        return default
+
+
+class SharedWordTags(object):
+    ''' Tag dictionary of a shared model (see CompiledModel.word_tags),
+        computed from the mapped emission table on demand
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.shared = {}
+
+    def __getitem__(self, word_id):
+        T = self.model.T
+        log_e = self.model.log_e
+        tags = tuple([v for v in range(1, T-1) if log_e[word_id*T + v] != NEG_INF])
+        return self.shared.setdefault(tags, tags)
+
+
+class SharedModel(CompiledModel):
+    ''' A CompiledModel whose tables are read from a shared, memory-mapped
+        segment (see attach), without copying them into this process
+    '''
+
+    def __init__(self, data, layout, path, fd):
+        self.data = data
+        self.path = path
+        self.fd = fd
+        self.tags = data[layout['offset']:layout['words_offset']].split('\n')
+        self.T = layout['T']
+        self.V = layout['V']
+        self.n_frequent = layout['n_frequent']
+        self.START = 0
+        self.STOP = self.T - 1
+        self.tag_ids = dict((tag, i) for i, tag in enumerate(self.tags))
+        if sys.byteorder == 'big':
+            # The tables are little-endian: copy and swap them
+            self.log_q = array('d', data[layout['q_offset']:layout['e_offset']])
+            self.log_e = array('d', data[layout['e_offset']:layout['end']])
+            self.log_q.byteswap()
+            self.log_e.byteswap()
+        else:
+            # Zero-copy views of the (private, never written) mapping
+            self.log_q = (ctypes.c_double * (self.T*self.T*self.T)).from_buffer(data, layout['q_offset'])
+            self.log_e = (ctypes.c_double * ((self.V+1)*self.T)).from_buffer(data, layout['e_offset'])
+        self.words = SharedWords(data, layout['words_offset'], layout['words_end'], self.n_frequent)
+        self.word_ids = self.words
+        self.word_tags = SharedWordTags(self)
@@ -0,0 +1,146 @@
+import sys, time, argparse, itertools, multiprocessing
+from tagger import Tagger, ENGINES
+from eval_gene_tagger import Evaluator, corpus_iterator, tagged_sentences, get_spans
+
+'''
+Sweep the rare word settings of the gene tagger: every combination of
+rare_cnt_threshold and set of RARE word categories is folded, tagged and
+scored, and a table of F1-Score and decoding speed is printed:
+
+    python sweep.py --thresholds 2,3,5,8 --categories numeric+allcaps+lastcap,numeric,none
+
+Categories are named after Tagger.category_keywords (ie, "numeric" for
+_NUMERIC_); the catch-all _RARE_ category is always used. The counts file
+is parsed once; each configuration is derived from the parsed counts
+(Tagger.derive) and configurations run in parallel worker processes.
+'''
+
+# Counts, sentences and gold standard used by the sweep worker processes
+# (set by init_sweep_worker before the workers are forked)
+sweep_tagger = None
+sweep_sentences = None
+sweep_gold_spans = None
+
+
+def init_sweep_worker(tagger, sentences, gold_spans):
+    global sweep_tagger, sweep_sentences, sweep_gold_spans
+    sweep_tagger = tagger
+    sweep_sentences = sentences
+    sweep_gold_spans = gold_spans
+
+def get_categories(names):
+    ''' Return the (category_keywords, category_patterns) of the named
+        categories (ie, ["numeric", "allcaps"]), in Tagger order, plus the
+        catch-all
+    '''
+    keywords = []
+    patterns = []
+    for keyword, pattern in zip(Tagger.category_keywords, Tagger.category_patterns):
+        if keyword.strip('_').lower() in names:
+            keywords.append(keyword)
+            patterns.append(pattern)
+    if len(keywords) != len(set(names)):
+        unknown = set(names) - set(keyword.strip('_').lower() for keyword in keywords)
+        raise Exception('Unknown word category: %s' % ', '.join(sorted(unknown)))
+    return keywords + Tagger.category_keywords[-1:], patterns
+
+def run_config(config):
+    ''' Fold, compile, tag and score one (threshold, category names, engine,
+        beam) configuration in a sweep worker process
+        @return dictionary of the configuration's scores and timings
+    '''
+    threshold, names, engine, beam = config
+    start = time.time()
+    keywords, patterns = get_categories(names)
+    tagger = sweep_tagger.derive(threshold, keywords, patterns)
+    tagger.flag_rare_words()
+    tagger.compile_model()
+    build_secs = time.time() - start
+
+    start = time.time()
+    tagged = [tagger.get_sentence_tags(sentence, engine, beam)[0] for sentence in sweep_sentences]
+    decode_secs = time.time() - start
+
+    evaluator = Evaluator()
+    offset = 0
+    for sentence, tags, gold_spans in itertools.izip(sweep_sentences, tagged, sweep_gold_spans):
+        evaluator.add_spans(gold_spans, get_spans(tags, offset))
+        offset += len(sentence) + 1
+    prec, rec, fscore = evaluator.get_scores()
+    tokens = sum(len(sentence) for sentence in sweep_sentences)
+    return {
+        'threshold': threshold,
+        'categories': '+'.join(names) or 'none',
+        'precision': prec,
+        'recall': rec,
+        'f1': fscore,
+        'build_secs': build_secs,
+        'tokens_per_sec': tokens / max(decode_secs, 1e-9),
+    }
+
+def run_sweep(counts_file, input_file, key_file, thresholds, category_sets,
+              engine='viterbi', beam=None, workers=1):
+    ''' Score every combination of the given thresholds and category sets
+        (lists of category names) and return a list of run_config results,
+        in grid order
+    '''
+    tagger = Tagger()
+    tagger.read_tag_count_file(counts_file)
+    sentences = list(tagger.iter_sentences(open(input_file, 'r')))
+    # Extract the gold standard entities once, for every configuration
+    gold_spans = []
+    offset = 0
+    for words, ne_tags in tagged_sentences(corpus_iterator(open(key_file, 'r'))):
+        gold_spans.append(get_spans(ne_tags, offset))
+        offset += len(words) + 1
+    if len(gold_spans) != len(sentences):
+        raise Exception('%s has %i sentences, but %s has %i'
+                        % (key_file, len(gold_spans), input_file, len(sentences)))
+
+    configs = [(threshold, names, engine, beam) for threshold in thresholds for names in category_sets]
+    if workers <= 1:
+        init_sweep_worker(tagger, sentences, gold_spans)
+        return [run_config(config) for config in configs]
+    pool = multiprocessing.Pool(workers, init_sweep_worker, (tagger, sentences, gold_spans))
+    try:
+        results = pool.map(run_config, configs, 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def print_results(results):
+    ''' Output a table of the sweep results, best F1-Score first
+    '''
+    print 'threshold\tcategories\t\tprecision\trecall\t\tF1-Score\ttokens/sec\tbuild secs'
+    for result in sorted(results, key=lambda result: -result['f1']):
+        print '%i\t\t%-20s\t%f\t%f\t%f\t%.0f\t\t%.3f' % (
+            result['threshold'], result['categories'], result['precision'], result['recall'],
+            result['f1'], result['tokens_per_sec'], result['build_secs'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep rare word thresholds and categories of the gene tagger')
+    parser.add_argument('--counts', default='gene.counts', help='tag counts file (not rare-folded)')
+    parser.add_argument('--input', default='gene.dev', help='file of sentences to tag')
+    parser.add_argument('--key', default='gene.key', help='gold standard tags of the input file')
+    parser.add_argument('--thresholds', default='2,3,5,8,10',
+                        help='comma separated rare_cnt_threshold values')
+    parser.add_argument('--categories', default='numeric+allcaps+lastcap,numeric+allcaps,numeric,none',
+                        help='comma separated sets of "+" separated word categories ("none" for only _RARE_)')
+    parser.add_argument('--engine', default='viterbi', choices=ENGINES)
+    parser.add_argument('--beam', type=int, default=None, help='beam width (exact decoding if not given)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='configurations run in parallel')
+    args = parser.parse_args()
+
+    thresholds = [int(threshold) for threshold in args.thresholds.split(',')]
+    category_sets = [[name for name in names.split('+') if name != 'none'] for names in args.categories.split(',')]
+    start = time.time()
+    results = run_sweep(args.counts, args.input, args.key, thresholds, category_sets,
+                        args.engine, args.beam, args.workers)
+    print_results(results)
+    print >> sys.stderr, 'Swept %i configurations in %.2f secs' % (len(results), time.time() - start)
@@ -1,99 +1,1009 @@
-import os, re
+import os, sys, re, math, time, hashlib, threading, weakref, multiprocessing, itertools, heapq
+from operator import itemgetter
 import count_freqs
+from compiled_model import CompiledModel
+from lru_cache import LRUCache
+from result_cache import ResultCache
+from decode_context import DecodeContext
+from instrumentation import COUNTERS, TIMERS, new_counters, timed_iter, ProgressReporter
+
+try:
+    import numpy
+except ImportError:
+    # numpy is only required by the 'numpy' decoding engine and forward-backward
+    numpy = None
+
+# Decoding engines of Tagger.decode (keep in step with its dispatch)
+ENGINES = ['viterbi', 'numpy', 'checkpoint', 'recursive']
+
+# Tagger, engine and beam used by the worker processes of Tagger.tag_sentences
+worker_tagger = None
+worker_engine = None
+worker_beam = None
+
+def init_worker(tagger, engine, beam=None):
+    ''' Pool initializer: keep the (already loaded) tagger for this worker process
+    '''
+    global worker_tagger, worker_engine, worker_beam
+    worker_tagger = tagger
+    worker_engine = engine
+    worker_beam = beam
+
+def tag_sentence_worker(sentence):
+    ''' Decode one sentence in a worker process and return the tuple (tags, prob)
+    '''
+    return worker_tagger.get_sentence_tags(sentence, worker_engine, worker_beam)
+
+def score_sentence_worker(sentence):
+    ''' Decode one sentence in a worker process and return the tuple
+        (tags, scores) (see Tagger.get_tag_scores)
+    '''
+    tags, prob = worker_tagger.get_sentence_tags(sentence, worker_engine, worker_beam)
+    return (tags, worker_tagger.get_tag_scores(sentence, tags))
+
+def format_tagged(sentence, tags, tag_scores=None):
+    ''' Return the lines of a tagged sentence, one "word tag" per word (or
+        "word tag log_prob" if tag_scores is given) and a blank line after
+        the sentence (the format of Tagger.tag_file)
+    '''
+    if tag_scores is not None:
+        return ''.join(['%s %s %f\n' % (sentence[i], tags[i], tag_scores[i]) for i in range(len(sentence))]) + '\n'
+    return ''.join([sentence[i] + ' ' + tags[i] + '\n' for i in range(len(sentence))]) + '\n'
 
 class Tagger(object):
-    # emissions is dictionary with structure:
-    #    emissions[tag] = {word1: count}
-    #    ie, emissions[I-GENE] = {'hydrolase': 2, 'opsin': 1}
-    trained_tag_counts = {}
-    trained_word_counts = {}
-    emission_counts = {}
-    ngrams = {}
+    # compiled integer-ID model used by the decoders (see compile_model)
+    compiled = None
+    # sha1 digest of the counts file read by read_tag_count_file
+    counts_checksum = None
+    # each DecodeContext's token cache holds at most token_cache_size words
+    # (see get_token)
+    token_cache_size = 50000
+    # most lattice cells the 'checkpoint' engine holds at once (see
+    # viterbi_checkpoint)
+    checkpoint_max_cells = 1 << 20
+    # numpy_tables used by the 'numpy' engine (see build_numpy_tables)
+    numpy_tables = None
+    # result_cache holds decoded sentences (see enable_result_cache), for
+    # the model cache_model (see get_result_cache)
+    result_cache = None
+    cache_model = None
 
-    # pi_cache used to improve performance of Viterbi algorithm
-    pi_cache = {}
+    # If instrument is True, decoding updates the counters and timers of
+    # its DecodeContext (see stats); tag_stream reports progress every
+    # progress_interval seconds (never if None)
+    instrument = False
+    progress_interval = 1.0
 
     # define the specialty categories to group infrequent words
     category_keywords = ['_NUMERIC_', '_ALLCAPS_', '_LASTCAP_', '_RARE_']
+    # pattern a word must match to fall in each category (tested in order),
+    # the last category is the catch-all
+    category_patterns = [
+        re.compile('[0-9]'),        # 0. Includes a number
+        re.compile('^[A-Z]+$'),     # 1. All Capital Letters
+        re.compile('^.*[A-Z]$'),    # 2. Ends in Capital Letter
+    ]
     rare_cnt_threshold = 5
 
+    def __init__(self):
+        # Counts are kept per instance, so several Taggers (ie, with different
+        # rare word settings, see derive) can be used in one process.
+        # emissions is dictionary with structure:
+        #    emissions[tag] = {word1: count}
+        #    ie, emissions[I-GENE] = {'hydrolase': 2, 'opsin': 1}
+        self.trained_tag_counts = {}
+        self.trained_word_counts = {}
+        self.emission_counts = {}
+        self.ngrams = {}
+
+        # rare_word_classes maps each rare training word to its RARE keyword
+        # (filled by flag_rare_words, which sets rare_words_flagged)
+        self.rare_word_classes = {}
+        self.rare_words_flagged = False
+
+        # Decoding state is kept in a DecodeContext per thread (see get_context)
+        self.init_contexts()
+
+    def init_contexts(self):
+        self.local = threading.local()
+        # contexts maps a weak reference to each live context to its
+        # counters; when a context dies (ie, its thread finished) its
+        # counters are added to finished_counters (see stats)
+        self.contexts = {}
+        self.finished_counters = new_counters()
+        # Reentrant: a context may die (and be collected) while it is held
+        self.contexts_lock = threading.RLock()
+
+    def __getstate__(self):
+        # Thread-local contexts and locks cannot be pickled, and are not
+        # needed by a copy of this Tagger
+        state = self.__dict__.copy()
+        for name in ('local', 'contexts', 'finished_counters', 'contexts_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_contexts()
+
+    def derive(self, rare_cnt_threshold=None, category_keywords=None, category_patterns=None):
+        ''' Return a new Tagger with a copy of this Tagger's counts, which
+            must not be rare-folded yet (flag_rare_words has not been run),
+            and the given rare word settings (this Tagger's if not given).
+            Run flag_rare_words on the new Tagger; this one is not changed,
+            so one set of parsed counts can be folded several ways.
+        '''
+        if self.rare_word_classes:
+            raise Exception('Cannot derive a Tagger from rare-folded counts')
+        tagger = Tagger()
+        tagger.trained_tag_counts = dict(self.trained_tag_counts)
+        tagger.trained_word_counts = dict(self.trained_word_counts)
+        tagger.emission_counts = dict((tag, dict(emissions)) for tag, emissions in self.emission_counts.iteritems())
+        tagger.ngrams = dict(self.ngrams)
+        tagger.counts_checksum = self.counts_checksum
+        tagger.rare_cnt_threshold = self.rare_cnt_threshold
+        if rare_cnt_threshold is not None:
+            tagger.rare_cnt_threshold = rare_cnt_threshold
+        if category_keywords is not None:
+            if category_patterns is None or len(category_patterns) != len(category_keywords) - 1:
+                raise Exception('Expected one pattern for each category keyword but the last')
+            tagger.category_keywords = category_keywords
+            tagger.category_patterns = category_patterns
+        return tagger
+
     def get_rare_keyword(self, word):
         ''' Return the most appropriate RARE category keyword based on properties
             of the given word
         '''
-        if re.search('[0-9]', word):
-            # 0. Includes a number
-            return self.category_keywords[0]
-        elif re.search('^[A-Z]+$', word):
-            # 1. All Capital Letters
-            return self.category_keywords[1]
-        elif re.search('^.*[A-Z]$', word):
-            # 2. Ends in Capital Letter
-            return self.category_keywords[2]
-        else:
-            # 3. Remaining Catch-all Rare word
-            return self.category_keywords[3]
+        for i, pattern in enumerate(self.category_patterns):
+            if pattern.search(word):
+                return self.category_keywords[i]
+        # 3. Remaining Catch-all Rare word
+        return self.category_keywords[-1]
 
-    def get_word_or_keyword(self, word):
+    def get_word_or_keyword(self, word, model=None):
         ''' If the given word is rare, return the appropriate RARE keyword,
             else just return the given word
         '''
-        if word not in self.trained_word_counts or self.trained_word_counts[word] < self.rare_cnt_threshold:
+        model = model or self.compiled
+        if model is not None:
+            is_rare = not model.is_frequent(word)
+        else:
+            is_rare = word not in self.trained_word_counts or self.trained_word_counts[word] < self.rare_cnt_threshold
+        if is_rare:
+            # Rare training words were classified by flag_rare_words
+            if word in self.rare_word_classes:
+                return self.rare_word_classes[word]
             # This word was not in training set, so assume it is a RARE keyword
             word = self.get_rare_keyword(word)
         return word
 
-    def get_possible_tags(self, k, N):
+    def get_possible_tags(self, k, N, sentence=None, context=None):
         ''' List the possible tags at location `k` in sentence of length `N`
+            If the sentence is given, only list the tags that can emit its
+            word at location `k` (see CompiledModel.word_tags)
         '''
         if k < 0:
             return ['*']
         elif k >= N:
             return ['STOP']
+        elif sentence is not None:
+            context = context or self.get_context()
+            tag_ids = self.get_token(sentence[k], context)[3]
+            return [context.model.tags[v] for v in tag_ids]
         else:
             return self.trained_tag_counts.keys()
 
-    def get_sentence_tags(self, sentence):
+    def get_sentence_tags(self, sentence, engine='viterbi', beam=None, context=None):
         ''' Run viterbi algorithm to get arg max tags for the given
             (space-separated) sentence
+            @param string engine. 'viterbi' (iterative, log-space, and the
+                fastest engine for the shipped tag set), 'numpy' (vectorized
+                viterbi), 'checkpoint' (viterbi in bounded memory,
+                for very long sentences) or 'recursive' (pi)
+            @param int beam. If given, use beam_search with this beam width
+                instead of the (exact) engine
+            @param DecodeContext context. Decoding state to use (this
+                thread's context, see get_context, if not given)
+            @return tuple (tags, prob). prob is a log probability unless engine is 'recursive'
+        '''
+        context = context or self.get_context()
+        cache = self.get_result_cache(context.model)
+        if cache is not None:
+            key = self.get_result_key(sentence, engine, beam)
+            cached = cache.get(key)
+            if cached is not None:
+                return (list(cached[0]), cached[1])
+        if not self.instrument:
+            result = self.decode(sentence, engine, beam, context)
+        else:
+            counters = context.counters
+            normalize_secs = counters['normalize_secs']
+            start = time.time()
+            result = self.decode(sentence, engine, beam, context)
+            counters['decode_secs'] += time.time() - start - (counters['normalize_secs'] - normalize_secs)
+            counters['sentences'] += 1
+        if cache is not None:
+            cache.put(key, (tuple(result[0]), result[1]))
+        return result
+
+    def decode(self, sentence, engine='viterbi', beam=None, context=None):
+        ''' Decode the sentence with the given engine (see get_sentence_tags).
+            Engines added here must also be listed in ENGINES.
         '''
+        if beam:
+            return self.beam_search(sentence, beam, context)
+        elif engine == 'viterbi':
+            return self.viterbi(sentence, context)
+        elif engine == 'numpy':
+            return self.viterbi_numpy(sentence, context)
+        elif engine == 'checkpoint':
+            return self.viterbi_checkpoint(sentence, context)
+        elif engine == 'recursive':
+            return self.recursive_viterbi(sentence, context)
+        else:
+            raise Exception('Unknown decoding engine: %s' % engine)
+
+    def recursive_viterbi(self, sentence, context=None):
+        ''' Run the recursive viterbi algorithm (see pi) on the sentence.
+            pi reads the counts, so a Tagger holding only a compiled model
+            (see load_compiled and attach_shared) cannot use this engine.
+            @return tuple (tags, prob)
+        '''
+        if not self.trained_tag_counts:
+            raise Exception('The recursive engine needs the counts, which a loaded compiled model does not have')
+        context = context or self.get_context()
+        N = len(sentence)
+        # pi() recurses once per word
+        if N + 50 > sys.getrecursionlimit():
+            raise Exception('Sentence of %i words is too long for the recursive engine '
+                            '(use the checkpoint engine)' % N)
+        self.get_tokens(sentence, context)
         max_prob = 0
         max_tags = []
-        N = len(sentence)
         # clear pi_cache
-        self.pi_cache = {}
-        self.bp_cache = [None]*N
+        context.pi_cache = {}
         # For each possible tag at word location N-1
-        for v in self.get_possible_tags(N-1, N):
-            tags, prob = self.pi(N, v, 'STOP', sentence)
+        for v in self.get_possible_tags(N-1, N, sentence, context):
+            tags, prob = self.pi(N, v, 'STOP', sentence, context)
             if prob >= max_prob:
                 max_prob = prob
                 max_tags = tags
-        # Remove initial start tags from max_tags list
-        max_tags = max_tags[2:]
+        # Remove the initial start tags and the final STOP from max_tags list
+        max_tags = max_tags[2:N+2]
         return (max_tags, max_prob)
         
 
-    def pi(self, k, u, v, sentence):
+    def compile_model(self):
+        ''' Intern tags and words to integer IDs and precompute the transition
+            and emission log probabilities used by the 'viterbi' and 'numpy'
+            engines. Run after read_tag_count_file and flag_rare_words (the
+            decoders compile on first use if this has not been done).
+        '''
+        self.compiled = CompiledModel.from_tagger(self)
+        self.numpy_tables = None
+        return self.compiled
+
+    def save_compiled(self, filename):
+        ''' Write the compiled (rare-folded) model to a binary file that
+            load_compiled can memory-map, instead of re-parsing the counts file
+        '''
+        model = self.compiled or self.compile_model()
+        if self.counts_checksum is None:
+            raise Exception('Cannot save a model that was not read from a counts file')
+        model.save(filename, self.rare_cnt_threshold, self.counts_checksum, self.categories_checksum())
+
+    def load_compiled(self, filename, counts_filename=None):
+        ''' Load a model written by save_compiled. Every engine but
+            'recursive' (which reads the counts) can decode with a model
+            loaded this way.
+            Refuses a file compiled with a different rare_cnt_threshold or
+            word categories, or, if counts_filename is given, from a
+            different counts file.
+        '''
+        model, metadata = CompiledModel.load(filename)
+        return self.use_compiled(model, metadata, filename, counts_filename)
+
+    def publish_shared(self, name):
+        ''' Publish the compiled model to the shared-memory segment name (see
+            shared_model), so tagging workers on this host can attach to it
+            with attach_shared instead of each loading their own copy. This
+            Tagger then decodes with the shared model too.
+        '''
+        import shared_model # Needs fcntl, so only imported when used
+        model = self.compiled or self.compile_model()
+        if self.counts_checksum is None:
+            raise Exception('Cannot publish a model that was not read from a counts file')
+        model, metadata = shared_model.publish(model, name, self.rare_cnt_threshold, self.counts_checksum,
+                                               self.categories_checksum())
+        return self.use_compiled(model, metadata, name)
+
+    def attach_shared(self, name, counts_filename=None):
+        ''' Decode with the model published to the shared-memory segment name
+            (see publish_shared), reading its tables in place. Checked like
+            load_compiled; the segment is released when this process exits
+            (or by detach_shared).
+        '''
+        import shared_model
+        model, metadata = shared_model.attach(name)
+        try:
+            return self.use_compiled(model, metadata, name, counts_filename)
+        except:
+            shared_model.detach(model)
+            raise
+
+    def detach_shared(self):
+        ''' Release the shared-memory model this Tagger decodes with, if any
+            (the last process to release a segment removes it)
+        '''
+        shared_model = sys.modules.get('shared_model')
+        if shared_model and isinstance(self.compiled, shared_model.SharedModel):
+            shared_model.detach(self.compiled)
+
+    def use_compiled(self, model, metadata, filename, counts_filename=None):
+        ''' Decode with a loaded compiled model, after checking its metadata
+            (see load_compiled)
+        '''
+        if metadata['n'] != 3:
+            raise Exception('Compiled model %s has n-gram order %i, expected 3'
+                            % (filename, metadata['n']))
+        if metadata['rare_cnt_threshold'] != self.rare_cnt_threshold:
+            raise Exception('Compiled model %s has rare_cnt_threshold %i, expected %i'
+                            % (filename, metadata['rare_cnt_threshold'], self.rare_cnt_threshold))
+        if metadata['categories_checksum'] != self.categories_checksum():
+            raise Exception('Compiled model %s was folded with other word categories than %s'
+                            % (filename, ', '.join(self.category_keywords)))
+        if counts_filename is not None:
+            try:
+                file = open(counts_filename, 'r')
+            except:
+                raise Exception('Cannot open file: %s' % counts_filename)
+            checksum = hashlib.sha1(file.read()).digest()
+            file.close()
+            if checksum != metadata['source_checksum']:
+                raise Exception('Compiled model %s is stale: %s has changed'
+                                % (filename, counts_filename))
+        self.counts_checksum = metadata['source_checksum']
+        self.compiled = model
+        self.numpy_tables = None
+        return model
+
+    def enable_result_cache(self, maxsize=10000, filename=None, disk_maxsize=None):
+        ''' Keep the results of get_sentence_tags in a ResultCache of maxsize
+            sentences, and also in the shelve file filename (of at most
+            disk_maxsize sentences) if given, so repeated sentences are not
+            decoded again (even after a restart)
+        '''
+        self.close_result_cache()
+        self.result_cache = ResultCache(maxsize, filename, disk_maxsize)
+        self.cache_model = None
+        return self.result_cache
+
+    def get_result_cache(self, model=None):
+        ''' Return the result cache (None if not enabled), emptied first if
+            the compiled model changed since it was last checked. The model
+            fingerprint is only computed when the model changes.
+        '''
+        cache = self.result_cache
+        if cache is not None:
+            model = model or self.compiled or self.compile_model()
+            if model is not self.cache_model:
+                cache.set_fingerprint(self.model_fingerprint())
+                self.cache_model = model
+        return cache
+
+    def close_result_cache(self):
+        ''' Stop caching results, writing the on-disk tier (if any) to disk
+        '''
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
+
+    def model_fingerprint(self):
+        ''' Return a digest identifying the model: the counts it was read
+            from and the rare_cnt_threshold and word categories it was
+            folded with
+        '''
+        return hashlib.sha1('%s %i %s' % (self.counts_checksum or '', self.rare_cnt_threshold,
+                                          self.categories_checksum())).hexdigest()
+
+    def categories_checksum(self):
+        ''' Return the sha1 digest of the RARE word categories (keywords and
+            patterns), stored with compiled models (see save_compiled)
+        '''
+        categories = ' '.join(self.category_keywords + [pattern.pattern for pattern in self.category_patterns])
+        return hashlib.sha1(categories).digest()
+
+    def get_result_key(self, sentence, engine='viterbi', beam=None):
+        ''' Return the result cache key of a sentence decoded with the given
+            engine and beam
+        '''
+        return hashlib.sha1('%s %s\n%s' % (engine, beam, '\n'.join(sentence))).hexdigest()
+
+    def get_context(self):
+        ''' Return the calling thread's DecodeContext for the current compiled
+            model (compiling it first if needed). Each thread decodes with
+            its own context, so threads can share this Tagger without locks
+            as long as the model is not changed (compile_model, apply_delta,
+            load_compiled) while they decode.
+        '''
+        model = self.compiled or self.compile_model()
+        context = getattr(self.local, 'context', None)
+        if context is None:
+            context = self.local.context = self.new_context()
+        elif context.model is not model:
+            context.reset(model)
+        return context
+
+    def new_context(self):
+        ''' Return a new DecodeContext for the current compiled model, ie
+            to pass to get_sentence_tags from a thread of a thread pool
+        '''
+        context = DecodeContext(self.compiled or self.compile_model(), self.token_cache_size)
+        with self.contexts_lock:
+            self.contexts[weakref.ref(context, self.drop_context)] = context.counters
+        return context
+
+    def drop_context(self, reference):
+        ''' Weak reference callback: fold the counters of a dead context
+            into finished_counters
+        '''
+        with self.contexts_lock:
+            counters = self.contexts.pop(reference, None)
+            if counters is not None:
+                for name in COUNTERS + TIMERS:
+                    self.finished_counters[name] += counters[name]
+
+    def get_token(self, word, context=None):
+        ''' Return the tuple (normalized word, word ID, emission vector, tag IDs)
+            for the given raw word, where emission vector[v] = log e(word|v) for
+            each compiled tag ID v, and tag IDs are the tags that emit the word.
+            Results are kept in the bounded LRU cache of the decoding context,
+            so repeated words are not normalized again.
+        '''
+        context = context or self.get_context()
+        cache = context.token_cache
+        entry = cache.get(word)
+        if entry is None:
+            model = context.model
+            normalized = self.get_word_or_keyword(word, model)
+            word_id = model.get_word_id(normalized)
+            entry = (normalized, word_id, model.log_e[word_id*model.T:(word_id+1)*model.T],
+                     model.word_tags[word_id])
+            cache.put(word, entry)
+        return entry
+
+    def token_cache_stats(self):
+        ''' Return the size, maxsize, hits, misses and hit_rate of the token
+            caches of all decoding contexts (size and maxsize are per context)
+        '''
+        stats = LRUCache(self.token_cache_size).stats()
+        with self.contexts_lock:
+            contexts = [reference() for reference in self.contexts]
+        for context in contexts:
+            if context is None:
+                continue
+            for name in ('hits', 'misses'):
+                stats[name] += context.token_cache.stats()[name]
+            stats['size'] = max(stats['size'], len(context.token_cache))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = lookups and float(stats['hits']) / lookups or 0.0
+        return stats
+
+    def get_tokens(self, sentence, context=None):
+        ''' Return the get_token tuple of each word in sentence
+        '''
+        context = context or self.get_context()
+        if not self.instrument:
+            return [self.get_token(word, context) for word in sentence]
+        counters = context.counters
+        start = time.time()
+        tokens = [self.get_token(word, context) for word in sentence]
+        counters['normalize_secs'] += time.time() - start
+        counters['tokens'] += len(sentence)
+        counters['rare_word_fallbacks'] += sum(1 for word, token in itertools.izip(sentence, tokens)
+                                               if token[0] != word)
+        return tokens
+
+    def get_word_ids(self, sentence, context=None):
+        ''' Return the compiled word ID of each (normalized) word in sentence
+        '''
+        return [token[1] for token in self.get_tokens(sentence, context)]
+
+    def reset_stats(self):
+        ''' Set the instrumentation counters and timers of every decoding
+            context to zero
+        '''
+        with self.contexts_lock:
+            for counters in self.contexts.values():
+                counters.update(new_counters())
+            self.finished_counters = new_counters()
+
+    def stats(self):
+        ''' Return a snapshot of the instrumentation counters and timers,
+            summed over the decoding contexts of all threads (only updated
+            while instrument is True, and only in this process: the counts of
+            tag_sentences worker processes are not included), with the token
+            cache statistics under 'token_cache' (and the result cache
+            statistics under 'result_cache').
+        '''
+        with self.contexts_lock:
+            snapshot = dict(self.finished_counters)
+            for counters in self.contexts.values():
+                for name in COUNTERS + TIMERS:
+                    snapshot[name] += counters[name]
+        snapshot['token_cache'] = self.token_cache_stats()
+        if self.result_cache is not None:
+            snapshot['result_cache'] = self.result_cache.stats()
+        return snapshot
+
+    def count_lattice(self, states, counters):
+        ''' Add the states, transitions and emissions scored by viterbi over
+            the given per-position state lists to the instrumentation counters
+        '''
+        for p in range(2, len(states)):
+            counters['states_visited'] += len(states[p-1])*len(states[p])
+            counters['transition_lookups'] += len(states[p-2])*len(states[p-1])*len(states[p])
+            counters['emission_lookups'] += len(states[p])
+        # The STOP position has no emission
+        counters['emission_lookups'] -= 1
+
+    def viterbi(self, sentence, context=None):
+        ''' Iterative, log-space Viterbi algorithm over the compiled model.
+            Fills a score and backpointer table for each position of the
+            sentence (bottom-up, see viterbi_lattice), then recovers the arg max
+            tags with a single backtrace. Ties are broken the same way as the
+            recursive pi() method.
+            @return tuple (tags, log_prob) example: (["O", "I-GENE"], -12.7)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        N = len(sentence)
+        neg_inf = float('-inf')
+        states, emissions, score, backpointer = self.viterbi_lattice(sentence, context)
+
+        # Choose the tag at location N-1 that best precedes STOP
+        max_prob = neg_inf
+        max_i = None
+        for i in range(len(states[N+1])):
+            if score[N+2][i][0] != neg_inf and score[N+2][i][0] >= max_prob:
+                max_prob = score[N+2][i][0]
+                max_i = i
+        if max_i is None:
+            return ([], neg_inf)
+
+        # Backtrace from STOP to the start of the sentence
+        tags = []
+        i, j = max_i, 0
+        for p in range(N+2, 2, -1):
+            tags.append(model.tags[states[p-1][i]])
+            i, j = backpointer[p][i][j], i
+        tags.reverse()
+        return (tags, max_prob)
+
+    def viterbi_lattice(self, sentence, context=None):
+        ''' Fill the Viterbi lattice of sentence, up to and including STOP.
+            states[p] lists the possible tag IDs at location k=p-2 (k = -2 .. N),
+            emissions[k] is the log e(word|tag) row of the word at k, and
+            score[p][i][j] is the max log prob of the tags ending
+            (states[p-1][i], states[p][j]), backpointer[p][i][j] the index in
+            states[p-2] of the tag before them.
+            @return tuple (states, emissions, score, backpointer)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        N = len(sentence)
+        tokens = self.get_tokens(sentence, context)
+        emissions = [token[2] for token in tokens]
+        # only tags that emit the word at k are possible
+        states = [[model.START], [model.START]] + [token[3] for token in tokens] + [[model.STOP]]
+        score = [None, [[0.0]]]
+        backpointer = [None, None]
+        if self.instrument:
+            self.count_lattice(states, context.counters)
+
+        for p in range(2, N+3):
+            p_score, p_backpointer = self.viterbi_step(model, score[p-1], states, p, emissions)
+            score.append(p_score)
+            backpointer.append(p_backpointer)
+        return (states, emissions, score, backpointer)
+
+    def kbest(self, sentence, k=None, context=None):
+        ''' Lazily generate the k best tag sequences of sentence (all of them
+            if k is None), best first, from a single Viterbi lattice (see
+            viterbi_lattice). Partial paths are extended backwards from STOP,
+            best-first: the lattice score of a cell is the best log prob of any
+            prefix ending there, so a partial path's suffix log prob plus the
+            score of its first cell is the best log prob of any full path it
+            is part of, and full paths come off the heap in order.
+            @return generator of tuples (tags, log_prob)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        T = model.T
+        log_q = model.log_q
+        N = len(sentence)
+        neg_inf = float('-inf')
+        states, emissions, score, backpointer = self.viterbi_lattice(sentence, context)
+
+        # heap entries are (-priority, order, suffix log prob, p, i, j, suffix)
+        # for the cell (p, i, j) of the lattice, where suffix links the tags of
+        # the cells after it as (p, j, suffix) down to STOP
+        heap = []
+        order = itertools.count()
+        for i in range(len(states[N+1])):
+            if score[N+2][i][0] != neg_inf:
+                heapq.heappush(heap, (-score[N+2][i][0], next(order), 0.0, N+2, i, 0, None))
+        found = 0
+        while heap and (k is None or found < k):
+            priority, n, suffix_prob, p, i, j, suffix = heapq.heappop(heap)
+            if p == 1:
+                # Reached the (*, *) start cell: the path is complete
+                tags = []
+                while suffix is not None:
+                    p, j, suffix = suffix
+                    if p <= N+1:
+                        tags.append(model.tags[states[p][j]])
+                found += 1
+                yield (tags, suffix_prob)
+                continue
+            u = states[p-1][i]
+            v = states[p][j]
+            emit = p-2 < N and emissions[p-2][v] or 0.0
+            for h, w in enumerate(states[p-2]):
+                if score[p-1][h][i] == neg_inf:
+                    continue
+                prob = suffix_prob + log_q[(w*T + u)*T + v] + emit
+                heapq.heappush(heap, (-(prob + score[p-1][h][i]), next(order), prob, p-1, h, i, (p, j, suffix)))
+
+    def viterbi_step(self, model, prev_score, states, p, emissions):
+        ''' Score the states at position p of the viterbi lattice from the
+            scores prev_score of position p-1
+            @return tuple (score, backpointer) where score[i][j] is the max log
+                prob of tags ending (states[p-1][i], states[p][j]) and
+                backpointer[i][j] the index in states[p-2] it came from
+        '''
+        T = model.T
+        log_q = model.log_q
+        neg_inf = float('-inf')
+        k = p-2
+        if k < len(emissions):
+            emission = emissions[k]
+            emit = [emission[v] for v in states[p]]
+        else:
+            # STOP always yields STOP
+            emit = [0.0]
+        p_score = []
+        p_backpointer = []
+        for i, u in enumerate(states[p-1]):
+            row_score = [neg_inf]*len(states[p])
+            row_backpointer = [None]*len(states[p])
+            for j, v in enumerate(states[p]):
+                # Skip state if tag v never emits word
+                if emit[j] == neg_inf:
+                    continue
+                max_score = neg_inf
+                for h, w in enumerate(states[p-2]):
+                    prob = prev_score[h][i]
+                    if prob == neg_inf:
+                        continue
+                    prob += log_q[(w*T + u)*T + v] + emit[j]
+                    if prob > max_score:
+                        max_score = prob
+                        row_backpointer[j] = h
+                row_score[j] = max_score
+            p_score.append(row_score)
+            p_backpointer.append(row_backpointer)
+        return (p_score, p_backpointer)
+
+    def viterbi_checkpoint(self, sentence, context=None, max_cells=None):
+        ''' Viterbi decoding in bounded memory and without recursion, for very
+            long sentences. The forward pass keeps the lattice scores of only
+            every K-th position (checkpoints); the backtrace then recomputes
+            the backpointers one segment of K positions at a time, from the
+            last segment to the first. With K about sqrt(N) the lattice takes
+            O(sqrt(N)) memory instead of O(N), for about twice the work.
+            Produces the same tags as viterbi().
+            @param int max_cells. Most lattice cells (scores and backpointers)
+                to hold at once (checkpoint_max_cells if not given). If the
+                whole lattice fits, the sentence is decoded by viterbi().
+            @return tuple (tags, log_prob)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        N = len(sentence)
+        neg_inf = float('-inf')
+        max_cells = max_cells or self.checkpoint_max_cells
+        tokens = self.get_tokens(sentence, context)
+        emissions = [token[2] for token in tokens]
+        states = [[model.START], [model.START]] + [token[3] for token in tokens] + [[model.STOP]]
+
+        # Choose the segment length K: positions 1, 1+K, 1+2K, ... are checkpointed
+        width = max(len(tags) for tags in states)**2
+        positions = N+2
+        if 2*positions*width <= max_cells:
+            return self.viterbi(sentence, context)
+        K = max(1, int(math.sqrt(positions)))
+        if (positions//K + 1 + 2*K)*width > max_cells:
+            raise Exception('Decoding a sentence of %i words needs more than %i lattice cells'
+                            % (N, max_cells))
+        if self.instrument:
+            self.count_lattice(states, context.counters)
+
+        # Forward pass, keeping only the checkpointed scores
+        checkpoints = {1: [[0.0]]}
+        score = checkpoints[1]
+        for p in range(2, N+3):
+            score = self.viterbi_step(model, score, states, p, emissions)[0]
+            if (p-1) % K == 0:
+                checkpoints[p] = score
+
+        # Choose the tag at location N-1 that best precedes STOP
+        max_prob = neg_inf
+        max_i = None
+        for i in range(len(states[N+1])):
+            if score[i][0] != neg_inf and score[i][0] >= max_prob:
+                max_prob = score[i][0]
+                max_i = i
+        if max_i is None:
+            return ([], neg_inf)
+
+        # Backtrace one segment (checkpoint c, positions c+1 .. end) at a time
+        tags = []
+        i, j = max_i, 0
+        end = N+2
+        while end > 2:
+            c = (end-2)//K*K + 1
+            score = checkpoints.pop(c)
+            backpointer = []
+            for p in range(c+1, end+1):
+                score, p_backpointer = self.viterbi_step(model, score, states, p, emissions)
+                backpointer.append(p_backpointer)
+            for p in range(end, max(c, 2), -1):
+                tags.append(model.tags[states[p-1][i]])
+                i, j = backpointer[p-c-1][i][j], i
+            end = c
+        tags.reverse()
+        return (tags, max_prob)
+
+    def beam_search(self, sentence, beam, context=None):
+        ''' Beam-search decoding over the compiled model: like viterbi, but only
+            the `beam` highest scoring (u, v) histories are kept at each position,
+            so the cost per word is bounded by beam * (number of tags). The
+            result may not be the arg max tags when beam < (number of tags)^2.
+            @return tuple (tags, log_prob)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        T = model.T
+        log_q = model.log_q
+        N = len(sentence)
+        neg_inf = float('-inf')
+        tokens = self.get_tokens(sentence, context)
+        counters = self.instrument and context.counters
+        # histories maps each kept (u, v) to its score,
+        # backpointers[k] maps each (u, v) at location k to the best w
+        histories = {(model.START, model.START): 0.0}
+        backpointers = []
+        for k in range(N+1):
+            if k < N:
+                emission = tokens[k][2]
+                tag_ids = tokens[k][3]
+            else:
+                # STOP always yields STOP
+                emission = None
+                tag_ids = (model.STOP,)
+            scores = {}
+            pointers = {}
+            for (w, u), prob in histories.iteritems():
+                offset = (w*T + u)*T
+                for v in tag_ids:
+                    score = prob + log_q[offset + v]
+                    if emission is not None:
+                        score += emission[v]
+                    if score > scores.get((u, v), neg_inf):
+                        scores[(u, v)] = score
+                        pointers[(u, v)] = w
+            if counters:
+                counters['states_visited'] += len(scores)
+                counters['transition_lookups'] += len(histories)*len(tag_ids)
+                counters['emission_lookups'] += emission is not None and len(histories)*len(tag_ids) or 0
+            if len(scores) > beam:
+                scores = dict(heapq.nlargest(beam, scores.iteritems(), key=itemgetter(1)))
+            histories = scores
+            backpointers.append(pointers)
+
+        if not histories:
+            return ([], neg_inf)
+        (u, v), max_prob = max(histories.iteritems(), key=itemgetter(1))
+
+        # Backtrace from STOP to the start of the sentence
+        tags = []
+        for k in range(N, 0, -1):
+            tags.append(model.tags[u])
+            u, v = backpointers[k][(u, v)], u
+        tags.reverse()
+        return (tags, max_prob)
+
+    def build_numpy_tables(self, model=None):
+        ''' Load the compiled model into the numpy arrays used by viterbi_numpy:
+            a TxTxT transition tensor log_q[w, u, v] = log q(v|w, u) and a
+            (V+1)xT emission matrix with one log e(word|tag) row per word ID.
+        '''
+        if numpy is None:
+            raise Exception('The numpy engine and forward-backward require numpy to be installed')
+        model = model or self.compiled or self.compile_model()
+        T = model.T
+        # Start state (*, *) and the emission column of the STOP position
+        start = numpy.full((T, T), float('-inf'))
+        start[model.START, model.START] = 0.0
+        stop_emit = numpy.full(T, float('-inf'))
+        stop_emit[model.STOP] = 0.0
+        # Views of the model's tables, not copies
+        self.numpy_tables = {
+            'model': model,
+            'log_q': numpy.frombuffer(model.log_q, dtype=float).reshape(T, T, T),
+            'log_e': numpy.frombuffer(model.log_e, dtype=float).reshape(model.V+1, T),
+            'start': start,
+            'stop_emit': stop_emit,
+        }
+        return self.numpy_tables
+
+    def viterbi_numpy(self, sentence, context=None):
+        ''' Vectorized log-space Viterbi algorithm. Each position is a single
+            broadcast max/argmax over the (w, u) plane:
+                score'[u, v] = max_w score[w, u] + log_q[w, u, v] + log e(x|v)
+            Produces the same tags as viterbi(). It is not a fast path for
+            the shipped O/I-GENE model: its TxTxT tensor is only 4x4x4, so
+            the per-position numpy call overhead outweighs the broadcast and
+            viterbi() (which only visits the tags each word can take)
+            decodes gene.dev faster. The broadcast can only pay off with a
+            much larger tag set.
+            @return tuple (tags, log_prob)
+        '''
+        context = context or self.get_context()
+        model = context.model
+        tables = self.numpy_tables
+        if tables is None or tables['model'] is not model:
+            tables = self.build_numpy_tables(model)
+        log_q = tables['log_q']
+        score = tables['start']
+        backpointers = []
+        columns = list(tables['log_e'][self.get_word_ids(sentence, context)])
+        columns.append(tables['stop_emit'])
+        if self.instrument:
+            T = model.T
+            context.counters['states_visited'] += T*T*len(columns)
+            context.counters['transition_lookups'] += T*T*T*len(columns)
+            context.counters['emission_lookups'] += len(sentence)
+        for emit in columns:
+            candidates = score[:, :, numpy.newaxis] + log_q
+            backpointers.append(candidates.argmax(axis=0))
+            score = candidates.max(axis=0) + emit
+
+        # Choose the tag at location N-1 that best precedes STOP (last wins ties)
+        final = score[::-1, model.STOP]
+        u = model.STOP - int(final.argmax())
+        max_prob = float(score[u, model.STOP])
+        if max_prob == float('-inf'):
+            return ([], max_prob)
+
+        # Backtrace from STOP to the start of the sentence
+        path = []
+        v = model.STOP
+        for backpointer in reversed(backpointers[1:]):
+            path.append(model.tags[u])
+            u, v = int(backpointer[u, v]), u
+        path.reverse()
+        return (path, max_prob)
+
+    def forward_backward(self, sentence, context=None):
+        ''' Posterior probability of every tag at each location of sentence,
+            summed over all tag sequences (see log_posteriors).
+            @return tuple (marginals, log_likelihood) where marginals[k] maps
+                each tag to its probability at location k, example:
+                ([{"O": 0.98, "I-GENE": 0.02}], -12.1), and log_likelihood is
+                the log prob of the sentence
+        '''
+        context = context or self.get_context()
+        model = context.model
+        posteriors, log_likelihood = self.log_posteriors(sentence, context)
+        tags = model.tags[1:model.STOP]
+        marginals = [dict(zip(tags, numpy.exp(row[1:model.STOP]).tolist())) for row in posteriors]
+        return (marginals, log_likelihood)
+
+    def get_tag_scores(self, sentence, tags, context=None):
+        ''' Return the posterior log prob of each of the given tags of
+            sentence (ie, the decoded tags), a per-token confidence
+        '''
+        context = context or self.get_context()
+        model = context.model
+        posteriors, log_likelihood = self.log_posteriors(sentence, context)
+        return [float(posteriors[k, model.tag_ids[tag]]) for k, tag in enumerate(tags)]
+
+    def log_posteriors(self, sentence, context=None):
+        ''' Vectorized log-space forward-backward algorithm over the same
+            (u, v) plane as viterbi_numpy, summing where viterbi maximizes:
+                alpha'[u, v] = logsumexp_w alpha[w, u] + log_q[w, u, v] + log e(x|v)
+                beta[u, v] = logsumexp_x log_q[u, v, x] + log e(x'|x) + beta'[v, x]
+            @return tuple (posteriors, log_likelihood) where posteriors is an
+                array of the log prob of tag ID v at location k,
+                posteriors[k, v], and log_likelihood the log prob of the sentence
+        '''
+        context = context or self.get_context()
+        model = context.model
+        tables = self.numpy_tables
+        if tables is None or tables['model'] is not model:
+            tables = self.build_numpy_tables(model)
+        log_q = tables['log_q']
+        columns = tables['log_e'][self.get_word_ids(sentence, context)]
+        N = len(sentence)
+
+        # Forward pass, alphas[k][u, v] = log prob of the words up to k with
+        # tags u, v at k-1, k
+        alphas = []
+        alpha = tables['start']
+        for k in range(N):
+            alpha = self.log_sum_exp(alpha[:, :, numpy.newaxis] + log_q, 0) + columns[k]
+            alphas.append(alpha)
+        log_likelihood = self.log_sum_exp(alpha + log_q[:, :, model.STOP])
+        posteriors = numpy.full((N, model.T), float('-inf'))
+        if log_likelihood == float('-inf'):
+            return (posteriors, log_likelihood)
+
+        # Backward pass, beta[u, v] = log prob of the words after k given tags
+        # u, v at k-1, k
+        beta = log_q[:, :, model.STOP]
+        for k in range(N-1, -1, -1):
+            posteriors[k] = self.log_sum_exp(alphas[k] + beta, 0) - log_likelihood
+            if k:
+                beta = self.log_sum_exp(log_q + columns[k] + beta[numpy.newaxis, :, :], 2)
+        return (posteriors, log_likelihood)
+
+    def log_sum_exp(self, values, axis=None):
+        ''' Return log(sum(exp(values))) of a numpy array along axis (of all
+            values if None), without underflow. -inf where all values are -inf.
+        '''
+        peak = values.max(axis=axis, keepdims=True)
+        peak[numpy.isneginf(peak)] = 0.0
+        with numpy.errstate(divide='ignore'):
+            total = numpy.log(numpy.exp(values - peak).sum(axis=axis, keepdims=True)) + peak
+        if axis is None:
+            return float(total)
+        return total.squeeze(axis)
+
+    def pi(self, k, u, v, sentence, context=None):
         ''' helper function for Viterbit algorithm
             This method is recursive. It traverses a sentence in reverse
             to calculate the most likely sequence of tags, based on
             likely tag-sequences (from HMM counts) and likely emissions
         '''
+        context = context or self.get_context()
+        pi_cache = context.pi_cache
+        counters = context.counters
         # If checking the STOP point of sentence, no emission involved STOP always yields STOP
         if k==len(sentence):
             emit_prob=1
         # Check for reasons to halt recursive algorithm
         elif k>=0:
             # Halt if tag v never emits word
-            word = self.get_word_or_keyword(sentence[k])
+            word = self.get_token(sentence[k], context)[0]
             emit_prob = self.get_emission_prob(word, v)
+            if self.instrument:
+                counters['emission_lookups'] += 1
             if emit_prob == 0:
                 return ([], 0)
 
+        if self.instrument:
+            if (k,u,v) in pi_cache:
+                counters['pi_cache_hits'] += 1
+            else:
+                counters['pi_cache_misses'] += 1
+                counters['states_visited'] += 1
+
         # Check for cached pi(k,u,v) value
-        if (k,u,v) in self.pi_cache:
-            return self.pi_cache[(k,u,v)]
+        if (k,u,v) in pi_cache:
+            return pi_cache[(k,u,v)]
         # Check for base case
         elif k==-1:
             if u=='*' and v=='*':
@@ -105,16 +1015,18 @@ class Tagger(object):
         else:
             max_prob = 0
             max_tags = []
-            for w in self.get_possible_tags(k-2, len(sentence)):
-                tags, prob = self.pi(k-1, w, u, sentence)
+            for w in self.get_possible_tags(k-2, len(sentence), sentence, context):
+                tags, prob = self.pi(k-1, w, u, sentence, context)
                 if prob != 0:
+                    if self.instrument:
+                        counters['transition_lookups'] += 1
                     prob *= self.get_trigram_prob(v, w, u)
                     prob *= emit_prob
                     if prob > max_prob:
                         max_prob = prob
                         max_tags = tags+[v]
-        if (k,u,v) not in self.pi_cache:
-            self.pi_cache[(k,u,v)] = (max_tags, max_prob)
+        if (k,u,v) not in pi_cache:
+            pi_cache[(k,u,v)] = (max_tags, max_prob)
         return (max_tags, max_prob)
 
     def get_word_tag(self, word):
@@ -160,24 +1072,94 @@ class Tagger(object):
     def flag_rare_words(self):
         ''' For any word that appears infrequently in training set
             (with ANY tag), replace it with a RARE keyword in emissions data.
+            Makes one pass over the word counts and one over the emissions
+            (no copies), and records each rare word's keyword in rare_word_classes.
         '''
-        for word in self.trained_word_counts.copy():
-            count = self.trained_word_counts[word]
-            # If word is RARE, update RARE word and emissions counts
+        self.rare_word_classes = {}
+        rare_counts = {}
+        for word, count in self.trained_word_counts.iteritems():
             if count < self.rare_cnt_threshold:
                 rare_keyword = self.get_rare_keyword(word)
-                # Update the RARE keyword is in word_counts
-                if rare_keyword not in self.trained_word_counts:
-                    self.trained_word_counts[rare_keyword] = 0
-                self.trained_word_counts[rare_keyword] += count
-                
-                # Update the RARE keyword is in emissions
-                for tag in self.emission_counts.copy():
-                    if word in self.emission_counts[tag]:
-                        emit_cnt = self.emission_counts[tag][word]
-                        if rare_keyword not in self.emission_counts[tag]:
-                            self.emission_counts[tag][rare_keyword] = 0
-                        self.emission_counts[tag][rare_keyword] += emit_cnt
+                self.rare_word_classes[word] = rare_keyword
+                rare_counts[rare_keyword] = rare_counts.get(rare_keyword, 0) + count
+        self.rare_words_flagged = True
+
+        # Update the RARE keyword is in emissions
+        for tag, emissions in self.emission_counts.iteritems():
+            rare_emissions = {}
+            for word, emit_cnt in emissions.iteritems():
+                rare_keyword = self.rare_word_classes.get(word)
+                if rare_keyword is not None:
+                    rare_emissions[rare_keyword] = rare_emissions.get(rare_keyword, 0) + emit_cnt
+            for rare_keyword, emit_cnt in rare_emissions.iteritems():
+                emissions[rare_keyword] = emissions.get(rare_keyword, 0) + emit_cnt
+
+        # Update the RARE keyword is in word_counts
+        for rare_keyword, count in rare_counts.iteritems():
+            self.trained_word_counts[rare_keyword] = self.trained_word_counts.get(rare_keyword, 0) + count
+
+    def apply_delta(self, delta):
+        ''' Add the counts of a count_freqs.Hmm (ie, returned by Hmm.update) to
+            this Tagger, which must already have run flag_rare_words.
+            Word, tag, emission and n-gram counts are adjusted in place, words
+            move in or out of their RARE class as their count crosses
+            rare_cnt_threshold, and the compiled model (if any) is rebuilt.
+            A Tagger holding only a compiled model (see load_compiled and
+            attach_shared) has no counts to update and cannot take deltas.
+        '''
+        if not self.trained_word_counts or not self.ngrams:
+            raise Exception('Cannot apply a delta to a Tagger without counts (ie, a loaded compiled model)')
+        if not self.rare_words_flagged:
+            raise Exception('Cannot apply a delta before flag_rare_words')
+        # Group the new emission counts by word
+        word_deltas = {}
+        for (word, tag), count in delta.emission_counts.iteritems():
+            word_deltas.setdefault(word, {})[tag] = count
+
+        for word, tag_deltas in word_deltas.iteritems():
+            old_count = self.trained_word_counts.get(word, 0)
+            new_count = old_count + sum(tag_deltas.values())
+            for tag, count in tag_deltas.iteritems():
+                if tag not in self.trained_tag_counts:
+                    self.trained_tag_counts[tag] = 0
+                    self.emission_counts[tag] = {}
+                self.trained_tag_counts[tag] += count
+                self.emission_counts[tag][word] = self.emission_counts[tag].get(word, 0) + count
+            self.trained_word_counts[word] = new_count
+
+            rare_keyword = self.rare_word_classes.get(word)
+            if rare_keyword is not None and new_count >= self.rare_cnt_threshold:
+                # Word is no longer rare: take all of its counts out of its RARE keyword
+                del self.rare_word_classes[word]
+                self.trained_word_counts[rare_keyword] -= old_count
+                for tag, emissions in self.emission_counts.iteritems():
+                    emit_cnt = emissions.get(word, 0) - tag_deltas.get(tag, 0)
+                    if emit_cnt:
+                        emissions[rare_keyword] -= emit_cnt
+            elif new_count < self.rare_cnt_threshold:
+                if rare_keyword is None:
+                    # New rare word
+                    rare_keyword = self.get_rare_keyword(word)
+                    self.rare_word_classes[word] = rare_keyword
+                # Fold the new counts into the RARE keyword
+                self.trained_word_counts[rare_keyword] = \
+                    self.trained_word_counts.get(rare_keyword, 0) + new_count - old_count
+                for tag, count in tag_deltas.iteritems():
+                    emissions = self.emission_counts[tag]
+                    emissions[rare_keyword] = emissions.get(rare_keyword, 0) + count
+
+        for ngram_counts in delta.ngram_counts:
+            for ngram, count in ngram_counts.iteritems():
+                sequence = ' '.join(ngram)
+                self.ngrams[sequence] = self.ngrams.get(sequence, 0) + count
+
+        # The counts no longer match the counts file: chain the checksum, so
+        # the model fingerprint (and the result cache) follow the new counts
+        self.counts_checksum = hashlib.sha1((self.counts_checksum or '')
+                                            + repr(sorted(delta.emission_counts.items()))
+                                            + repr([sorted(c.items()) for c in delta.ngram_counts])).digest()
+        if self.compiled is not None:
+            self.compile_model()
 
     def read_tag_count_file(self, filename):
         ''' Read the given tag counts file and store results locally to Tagger instance
@@ -187,19 +1169,36 @@ class Tagger(object):
         except:
             raise Exception('Cannot open file: %s' % filename)
 
-        for line in file.readlines():
+        lines = file.readlines()
+        file.close()
+        self.counts_checksum = hashlib.sha1(''.join(lines)).digest()
+        for line in lines:
             row = line.split(' ')
             if row[1] == 'WORDTAG':
                 self.process_wordtag(row)
             elif 'GRAM' in row[1]:
                 self.process_ngram(row)
 
+    def read_hmm(self, hmm):
+        ''' Store the counts of a count_freqs.Hmm (ie, just trained) like
+            read_tag_count_file does, without writing and parsing a counts file
+        '''
+        for (word, tag), count in hmm.emission_counts.iteritems():
+            self.add_wordtag(int(count), tag, word)
+        for ngram_counts in hmm.ngram_counts:
+            for ngram, count in ngram_counts.iteritems():
+                self.add_ngram(int(count), ' '.join(ngram))
+        self.counts_checksum = hashlib.sha1(repr(sorted(hmm.emission_counts.items()))
+                                            + repr([sorted(c.items()) for c in hmm.ngram_counts])).digest()
+
     def process_wordtag(self, row):
         ''' Store the counts data for a WORDTAG row (ie, "4 WORDTAG I-GENE obsin")
         '''
-        count = int(row[0].strip())
-        tag = row[2].strip()
-        word = row[3].strip()
+        self.add_wordtag(int(row[0].strip()), row[2].strip(), row[3].strip())
+
+    def add_wordtag(self, count, tag, word):
+        ''' Add count to the counts of word emitted by tag
+        '''
         if tag not in self.trained_tag_counts:
             self.trained_tag_counts[tag] = 0
             self.emission_counts[tag] = {}
@@ -215,8 +1214,11 @@ class Tagger(object):
     def process_ngram(self, row):
         ''' Store the counts data for an N-GRAM row (ie, "15 3-GRAM I-GENE I-GENE O")
         '''
-        count = int(row[0].strip())
-        sequence = ' '.join(row[2:]).strip()
+        self.add_ngram(int(row[0].strip()), ' '.join(row[2:]).strip())
+
+    def add_ngram(self, count, sequence):
+        ''' Add count to the counts of a (space-separated) tag sequence
+        '''
         if sequence not in self.ngrams:
             self.ngrams[sequence] = 0
         self.ngrams[sequence] += count
@@ -236,11 +1238,151 @@ class Tagger(object):
                 sentence.append(word)
         return sentences
 
-    def tag_file(self, input_filename, output_filename):
+    def iter_sentences(self, file):
+        ''' Generate the sentences (lists of words) of the given file object
+            (ie, sys.stdin) one at a time, reading one line at a time.
+            Unlike get_sentences, a last sentence without a trailing blank
+            line is also generated.
+        '''
+        sentence = []
+        for row in iter(file.readline, ''):
+            word = row.strip()
+            if word=='':
+                yield sentence
+                sentence = []
+            else:
+                sentence.append(word)
+        if sentence:
+            yield sentence
+
+    def tag_sentences(self, sentences, engine='viterbi', workers=1, chunksize=64, beam=None, scores=False):
+        ''' Generate the tags of each sentence, in input order, or the tuple
+            (tags, scores) of each if scores is True (see get_tag_scores).
+            If workers > 1 the sentences are decoded by a pool of worker
+            processes. The model is loaded (compiled) once in this process
+            and inherited by each worker when the pool starts. Sentences are
+            handed to the pool in batches of workers*chunksize*2, so at most
+            that many are held in memory at once. With a result cache, only
+            the sentences missing from it are handed to the pool (scores are
+            not cached: with scores every sentence is).
+        '''
+        if workers <= 1:
+            for sentence in sentences:
+                tags, prob = self.get_sentence_tags(sentence, engine, beam)
+                if scores:
+                    yield (tags, self.get_tag_scores(sentence, tags))
+                else:
+                    yield tags
+            return
+
+        self.prepare_workers(engine, beam, scores)
+        # Check the cache fingerprint (which may recreate its on-disk tier)
+        # before the pool forks
+        cache = not scores and self.get_result_cache() or None
+        pool = self.start_pool(workers, init_worker, (self, engine, beam))
+        sentences = iter(sentences)
+        batch_size = workers*chunksize*2
+        try:
+            while True:
+                batch = list(itertools.islice(sentences, batch_size))
+                if not batch:
+                    break
+                if scores:
+                    for result in pool.imap(score_sentence_worker, batch, chunksize):
+                        yield result
+                    continue
+                if cache is None:
+                    for tags, prob in pool.imap(tag_sentence_worker, batch, chunksize):
+                        yield tags
+                    continue
+                keys = [self.get_result_key(sentence, engine, beam) for sentence in batch]
+                cached = [cache.get(key) for key in keys]
+                misses = [sentence for sentence, result in itertools.izip(batch, cached) if result is None]
+                decoded = pool.imap(tag_sentence_worker, misses, chunksize)
+                for key, result in itertools.izip(keys, cached):
+                    if result is None:
+                        tags, prob = decoded.next()
+                        cache.put(key, (tuple(tags), prob))
+                        yield tags
+                    else:
+                        yield list(result[0])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def prepare_workers(self, engine='viterbi', beam=None, scores=False):
+        ''' Build the tables the given engine decodes with (the compiled
+            model, which every engine uses to normalize words, and the numpy
+            tables of the 'numpy' engine and of scores) before a pool of
+            worker processes is forked, so the workers share them
+            copy-on-write instead of each building its own
+        '''
+        model = self.compiled or self.compile_model()
+        if engine == 'numpy' and not beam or scores:
+            tables = self.numpy_tables
+            if tables is None or tables['model'] is not model:
+                self.build_numpy_tables(model)
+
+    def start_pool(self, workers, initializer, initargs):
+        ''' Fork a multiprocessing.Pool of `workers` processes. The result
+            cache is detached from the tagger while the pool forks, so the
+            workers never hold its shelve (closing their copy would rewrite
+            the on-disk index of this process); this process looks
+            sentences up in the cache and is the only one writing it.
+        '''
+        cache = self.result_cache
+        self.result_cache = None
+        try:
+            return multiprocessing.Pool(workers, initializer, initargs)
+        finally:
+            self.result_cache = cache
+
+    def tag_stream(self, ifile, ofile, engine='viterbi', workers=1, beam=None, scores=False):
+        ''' Tag the sentences read from file object ifile and write them to
+            file object ofile as each one is decoded. Memory use depends only
+            on the longest sentence (and the worker batch size).
+            If scores is True, the posterior log prob of each tag is written
+            after it ("word tag log_prob", see eval_gene_tagger.corpus_iterator).
+            Progress is reported on stderr (see progress_interval), so ofile
+            may be sys.stdout.
+        '''
+        sentences = self.iter_sentences(ifile)
+        if self.instrument:
+            sentences = timed_iter(sentences, self.get_context().counters, 'io_secs')
+        sentences, pending = itertools.tee(sentences)
+        tagged = self.tag_sentences(pending, engine, workers, beam=beam, scores=scores)
+        counters = self.get_context().counters
+        progress = ProgressReporter(sys.stderr, self.progress_interval)
+        for s, tags in itertools.izip(sentences, tagged):
+            # One write per sentence, buffered by ofile
+            if scores:
+                lines = format_tagged(s, *tags)
+            else:
+                lines = format_tagged(s, tags)
+            if self.instrument:
+                start = time.time()
+                ofile.write(lines)
+                counters['io_secs'] += time.time() - start
+            else:
+                ofile.write(lines)
+            progress.update(len(s))
+        progress.finish()
+        if self.result_cache is not None:
+            self.result_cache.sync()
+
+    def tag_file(self, input_filename, output_filename, engine='viterbi', workers=1, beam=None, scores=False):
         ''' For each word, in each sentence in input_filename, find the 
             most likely tag and output results to output_filename.
             @param string input_filename. (File format ["This", "Gene", "myosin"])
             @param string output_filename. (File format ["This O", "Gene O", "myosin I-GENE"])
+            @param string engine. Decoding engine passed to get_sentence_tags
+            @param int workers. Number of processes decoding sentences in parallel
+            @param int beam. Beam width for beam_search (exact decoding if None)
+            @param bool scores. Also write the posterior log prob of each tag
+                (File format ["This O -0.000012", ...], see get_tag_scores)
         '''
         # Open input file for reading
         try:
@@ -249,18 +1391,12 @@ class Tagger(object):
             raise Exception('Cannot open file: %s' % input_filename)
         # Open output file for reading
         try:
-            ofile = open(output_filename, 'w')
+            ofile = open(output_filename, 'w', 1 << 16)
         except:
             raise Exception('Cannot open file: %s' % output_filename)
 
         # Read each sentence in input_file and write with proper tags to output
-        sentences = self.get_sentences(ifile.readlines())
-        for i,s in enumerate(sentences):
-            print 'Tagging sentence', str(i), '(# words= ', len(s), ')'
-            tags, prob = self.get_sentence_tags(s)
-            for i in range(len(s)):
-                ofile.write(' '.join([s[i], tags[i]]) + '\n')
-            ofile.write('\n')
+        self.tag_stream(ifile, ofile, engine, workers, beam, scores)
         ifile.close()
         ofile.close()
         return